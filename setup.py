@@ -19,6 +19,9 @@ setup(
         'django-vkontakte-users>=0.5.5',
         'django-vkontakte-groups>=0.3.8',
     ],
+    extras_require={
+        'lxml': ['lxml'],
+    },
     classifiers=[
         'Development Status :: 4 - Beta',
         'Environment :: Web Environment',
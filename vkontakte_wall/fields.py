@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+from django.db import models
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.encoding import smart_str, smart_unicode
+import base64
+import json
+import zlib
+
+try:
+    from south.modelsinspector import add_introspection_rules
+    SOUTH = True
+except ImportError:
+    SOUTH = False
+
+__all__ = ['CompressedTextField', 'CompressedJSONField', 'compress', 'decompress']
+
+# marker of compressed values, rows without it are stored as is and returned untouched
+COMPRESSED_PREFIX = 'zlib:'
+
+COMPRESS_LEVEL = getattr(settings, 'VKONTAKTE_WALL_COMPRESS_LEVEL', 6)
+# values shorter than this are not worth compressing
+COMPRESS_MIN_LENGTH = getattr(settings, 'VKONTAKTE_WALL_COMPRESS_MIN_LENGTH', 100)
+
+
+def compress(value):
+    '''
+    Return zlib compressed and base64 encoded string with COMPRESSED_PREFIX, short and already compressed values as is
+    '''
+    if not isinstance(value, basestring) or len(value) < COMPRESS_MIN_LENGTH or is_compressed(value):
+        return value
+    return COMPRESSED_PREFIX + base64.b64encode(zlib.compress(smart_str(value), COMPRESS_LEVEL))
+
+
+def decompress(value):
+    '''
+    Return unicode string from value made by compress(), not compressed values as is
+    '''
+    if not is_compressed(value):
+        return value
+    return smart_unicode(zlib.decompress(base64.b64decode(value[len(COMPRESSED_PREFIX):])))
+
+
+def is_compressed(value):
+    return isinstance(value, basestring) and value.startswith(COMPRESSED_PREFIX)
+
+
+class CompressedTextField(models.TextField):
+    '''
+    Text field stored compressed in the text column of database, transparent on access.
+    Existing plain values are still read correctly, they are compressed on the next saving
+    '''
+    __metaclass__ = models.SubfieldBase
+
+    def to_python(self, value):
+        return decompress(value)
+
+    def get_prep_value(self, value):
+        return compress(super(CompressedTextField, self).get_prep_value(value))
+
+
+class LazyJSONDescriptor(object):
+    '''
+    Keep value of the field loaded from DB as is and deserialize it on the first access
+    '''
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, obj, type=None):
+        if obj is None:
+            return self
+        value = obj.__dict__[self.field.name]
+        if isinstance(value, basestring):
+            value = obj.__dict__[self.field.name] = self.field.to_python(value)
+        return value
+
+    def __set__(self, obj, value):
+        obj.__dict__[self.field.name] = value
+
+
+class CompressedJSONField(models.TextField):
+    '''
+    JSON field like annoying.fields.JSONField, stored compressed the same way as CompressedTextField.
+    Not SubfieldBase based, value is decompressed and deserialized only when it's accessed
+    '''
+    def contribute_to_class(self, cls, name):
+        super(CompressedJSONField, self).contribute_to_class(cls, name)
+        setattr(cls, self.name, LazyJSONDescriptor(self))
+
+    def to_python(self, value):
+        if value == '':
+            return None
+        try:
+            if isinstance(value, basestring):
+                return json.loads(decompress(value))
+        except ValueError:
+            pass
+        return value
+
+    def get_db_prep_save(self, value, *args, **kwargs):
+        if value == '':
+            return None
+        if isinstance(value, (dict, list)):
+            value = json.dumps(value, cls=DjangoJSONEncoder)
+        return compress(super(CompressedJSONField, self).get_db_prep_save(value, *args, **kwargs))
+
+    def value_from_object(self, obj):
+        value = super(CompressedJSONField, self).value_from_object(obj)
+        if self.null and value is None:
+            return None
+        return json.dumps(value)
+
+if SOUTH:
+    add_introspection_rules([], ["^vkontakte_wall\.fields\.CompressedTextField", "^vkontakte_wall\.fields\.CompressedJSONField"])
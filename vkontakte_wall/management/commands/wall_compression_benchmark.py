@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+from optparse import make_option
+from vkontakte_wall.models import Post, Comment
+from vkontakte_wall.fields import compress, decompress
+import time
+
+
+class Command(BaseCommand):
+    help = 'Measure size and time of compressing raw_html and raw_json of stored posts and comments'
+    option_list = BaseCommand.option_list + (
+        make_option('--count', action='store', dest='count', type='int', default=1000,
+                    help='Number of rows of each model to benchmark'),
+    )
+
+    def handle(self, *args, **options):
+        for model in [Post, Comment]:
+            # values_list returns values from database without decompressing
+            values = [decompress(value) for row in model.objects.values_list('raw_html', 'raw_json')[:options['count']]
+                      for value in row if value]
+            if not values:
+                self.stdout.write('%s: no rows' % model.__name__)
+                continue
+
+            started = time.time()
+            compressed = [compress(value) for value in values]
+            write_time = time.time() - started
+
+            started = time.time()
+            [decompress(value) for value in compressed]
+            read_time = time.time() - started
+
+            size = sum([len(value.encode('utf-8')) for value in values])
+            size_compressed = sum([len(value) for value in compressed])
+
+            self.stdout.write('%s: %d values, %d bytes -> %d bytes (%.1f%%), write %.3f ms, read %.3f ms per value' % (
+                model.__name__, len(values), size, size_compressed, 100. * size_compressed / size,
+                1000 * write_time / len(values), 1000 * read_time / len(values)))
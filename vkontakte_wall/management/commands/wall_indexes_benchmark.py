@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from optparse import make_option
+from vkontakte_wall.models import Post, Comment
+import time
+
+EXPLAIN_PREFIXES = {
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+    'postgresql': 'EXPLAIN ANALYZE ',
+    'mysql': 'EXPLAIN ',
+}
+
+
+class Command(BaseCommand):
+    help = 'Show query plans and time of timeline queries of posts of a wall and comments of a post. ' \
+           'Run it before and after migration 0019 to compare'
+    option_list = BaseCommand.option_list + (
+        make_option('--post', action='store', dest='post', default=None,
+                    help='Remote ID of post, by default post with the most comments'),
+        make_option('--repeat', action='store', dest='repeat', type='int', default=10,
+                    help='Number of runs of each query'),
+        make_option('--limit', action='store', dest='limit', type='int', default=100,
+                    help='Number of rows in each query'),
+    )
+
+    def handle(self, *args, **options):
+        if options['post']:
+            post = Post.objects.get(remote_id=options['post'])
+        else:
+            try:
+                post = Post.objects.order_by('-comments')[0]
+            except IndexError:
+                raise CommandError('There are no posts in DB')
+
+        querysets = [
+            ('Posts of wall %s' % post.wall_owner_id, Post.objects.filter(wall_owner_content_type=post.wall_owner_content_type_id,
+                                                                         wall_owner_id=post.wall_owner_id).order_by('-date')),
+            ('Comments of post %s' % post.remote_id, Comment.objects.filter(post=post).order_by('-date')),
+        ]
+
+        for title, queryset in querysets:
+            queryset = queryset[:options['limit']]
+            self.stdout.write(title)
+
+            prefix = EXPLAIN_PREFIXES.get(connection.vendor)
+            if prefix:
+                sql, params = queryset.query.sql_with_params()
+                cursor = connection.cursor()
+                cursor.execute(prefix + sql, params)
+                for row in cursor.fetchall():
+                    self.stdout.write('    %s' % ' '.join([unicode(value) for value in row]))
+
+            started = time.time()
+            for i in range(options['repeat']):
+                list(queryset.all())
+            self.stdout.write('    %.3f ms per query' % (1000 * (time.time() - started) / options['repeat']))
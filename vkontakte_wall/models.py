@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
-from django.db import models, transaction
+import django
+from django.db import models, transaction, connection, IntegrityError
+from django.db.models.query import QuerySet
 from django.dispatch import Signal
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
@@ -9,20 +11,440 @@ from vkontakte_api.utils import api_call
 from vkontakte_api import fields
 from vkontakte_api.models import VkontakteTimelineManager, VkontakteModel, VkontakteCRUDModel, VkontakteCRUDManager, VkontakteContentError, MASTER_DATABASE
 from vkontakte_api.decorators import fetch_all
+from vkontakte_api.signals import vkontakte_api_post_fetch
 from vkontakte_users.models import User, ParseUsersMixin
 from vkontakte_groups.models import Group, ParseGroupsMixin
 from m2m_history.fields import ManyToManyHistoryField
 from parser import VkontakteWallParser, VkontakteParseError
+from fields import CompressedTextField, CompressedJSONField
+from utils import execute_api_calls, rate_limiter
+from multiprocessing.pool import ThreadPool
 from datetime import datetime
+from StringIO import StringIO
+from contextlib import contextmanager
+import hashlib
 import logging
+import json
 import re
 
 log = logging.getLogger('vkontakte_wall')
 
 parsed = Signal(providing_args=['sender', 'instance', 'container'])
 
+# marker of field, which value was not loaded from DB
+FIELD_NOT_LOADED = object()
 
-class PostRemoteManager(VkontakteTimelineManager, ParseUsersMixin, ParseGroupsMixin):
+# store raw_html and raw_json in the side tables PostRaw and CommentRaw instead of the rows of posts and comments
+RAW_ARCHIVE = getattr(settings, 'VKONTAKTE_WALL_RAW_ARCHIVE', False)
+
+
+def get_content_type_id(model):
+    '''
+    Return id of content type of the model from cache of ContentType manager,
+    so it respects database alias and ContentType.objects.clear_cache()
+    '''
+    return ContentType.objects.get_for_model(model).pk
+
+
+@contextmanager
+def savepoint():
+    '''
+    Roll back changes of the block on exception, leaving outer transaction usable.
+    Django >= 1.6 marks outer atomic block as broken unless error is caught inside nested one, so atomic is used there
+    '''
+    if hasattr(transaction, 'atomic'):
+        with transaction.atomic():
+            yield
+        return
+
+    sid = transaction.savepoint()
+    try:
+        yield
+    except:
+        transaction.savepoint_rollback(sid)
+        raise
+    transaction.savepoint_commit(sid)
+
+
+class WallQuerySet(QuerySet):
+
+    def lean(self):
+        '''
+        Defer loading of heavy text fields of the model, they are loaded by separate query on access
+        '''
+        return self.defer(*self.model.lean_deferred_fields)
+
+    def full(self):
+        '''
+        Load all fields
+        '''
+        return self.defer(None)
+
+
+class WallManager(VkontakteCRUDManager):
+    '''
+    Default manager of posts and comments, used also by generic relations of groups and users.
+    Its querysets are lean, use full() for loading of all fields at once
+    '''
+    def get_query_set(self):
+        return WallQuerySet(self.model, using=self._db).lean()
+
+    def full(self):
+        return self.get_query_set().full()
+
+
+class WallRemoteManager(VkontakteTimelineManager):
+    '''
+    Common remote manager of posts and comments with ability to save fetched page of instances in bulk
+    '''
+    response_instances_fieldname = None
+
+    @transaction.commit_on_success
+    def fetch(self, *args, **kwargs):
+        '''
+        Retrieve and save objects to local DB
+        Additional attributes:
+         * 'bulk' - save all instances of response in bulk instead of saving them one by one.
+         * 'after_remote_id' - excluding all items with the same or lower ID on the wall, like 'after' does by date.
+        '''
+        bulk = kwargs.pop('bulk', False)
+        after = kwargs.pop('after', None)
+        before = kwargs.pop('before', None)
+        after_remote_id = kwargs.pop('after_remote_id', None)
+
+        result = self.get(*args, **kwargs)
+        if isinstance(result, list):
+            result = self.filter_timeline(result, after, before, after_remote_id)
+            if bulk:
+                return self.get_or_create_from_instances(result)
+            return self.model.objects.filter(pk__in=[self.get_or_create_from_instance(instance).pk for instance in result])
+        elif isinstance(result, QuerySet):
+            return result
+        else:
+            return self.get_or_create_from_instance(result)
+
+    def api_call(self, *args, **kwargs):
+        rate_limiter.acquire()
+        return super(WallRemoteManager, self).api_call(*args, **kwargs)
+
+    @transaction.commit_on_success
+    def fetch_execute(self, calls_kwargs, bulk=False):
+        '''
+        Retrieve and save objects of many `get` method calls, packed into `execute` requests.
+        Each item of `calls_kwargs` is a dict of kwargs of `fetch` method including 'extra_fields', 'after' and 'before'
+        '''
+        calls = [self.split_fetch_kwargs(kwargs) for kwargs in calls_kwargs]
+
+        responses = execute_api_calls([(self.get_method_name('get'), kwargs) for options, kwargs in calls],
+                                      methods_access_tag=self.model.methods_access_tag or None)
+
+        instances = self.model.objects.none()
+        for (options, kwargs), response in zip(calls, responses):
+            if response is not None:
+                instances |= self.save_response(response, options, bulk)
+
+        return instances
+
+    @transaction.commit_on_success
+    def fetch_pages_parallel(self, prepare_kwargs, workers, offset=0, count=100, bulk=False, **kwargs):
+        '''
+        Fetch the first page and then remaining pages concurrently by `workers` threads using total count of items from the first response.
+        Pages are requested in windows of `workers` pages, the next window is not requested if a page crossed `after` or was empty.
+        Only API requests are made in threads, responses are parsed and saved in the calling thread in order of offsets.
+        Argument `prepare_kwargs` is a method returning kwargs of `fetch` method for the page with given offset and count
+        '''
+        options, params = self.split_fetch_kwargs(prepare_kwargs(offset=offset, count=count, **kwargs))
+
+        def request(offset):
+            try:
+                return self.api_call(**dict(params, offset=offset))
+            finally:
+                # every thread has its own connection, opened while getting access token
+                connection.close()
+
+        response = self.api_call(**params)
+        instances = self.save_response(response, options, bulk)
+
+        total = self.get_response_count(response)
+        if not total or instances.count() < count:
+            return instances
+
+        offsets = range(offset + count, total, count)
+
+        log.debug('Fetching %d pages of %s by %d threads' % (len(offsets), self.model._meta.module_name, workers))
+
+        pool = ThreadPool(workers)
+        try:
+            for i in range(0, len(offsets), workers):
+                finished = False
+                for response in pool.map(request, offsets[i:i + workers]):
+                    page = self.save_response(response, options, bulk)
+                    instances |= page
+                    # the rest of pages are out of timeline or empty
+                    if page.count() < count:
+                        finished = True
+                        break
+                if finished:
+                    break
+        finally:
+            pool.terminate()
+
+        return instances
+
+    def split_fetch_kwargs(self, kwargs):
+        '''
+        Split kwargs of `fetch` method into options of parsing and saving and params of API call
+        '''
+        kwargs = dict(kwargs)
+        options = dict([(key, kwargs.pop(key, None)) for key in ['extra_fields', 'after', 'before', 'after_remote_id']])
+        return options, kwargs
+
+    def save_response(self, response, options, bulk=False):
+        '''
+        Parse and save response of `get` API call with respect to options returned by split_fetch_kwargs
+        '''
+        extra_fields = dict(options['extra_fields'] or {})
+        extra_fields['fetched'] = datetime.now()
+
+        result = self.filter_timeline(self.parse_response(response, extra_fields), options['after'], options['before'], options['after_remote_id'])
+        if bulk:
+            return self.get_or_create_from_instances(result)
+        else:
+            return self.model.objects.filter(pk__in=[self.get_or_create_from_instance(instance).pk for instance in result])
+
+    def get_response_count(self, response):
+        '''
+        Return total count of items from response, where it is the first item of list
+        '''
+        if isinstance(response, dict):
+            response = response.get(self.response_instances_fieldname, [])
+        if isinstance(response, list) and len(response) and isinstance(response[0], int):
+            return response[0]
+
+    def iter_pages(self, method, offset=0, count=100, **kwargs):
+        '''
+        Generator of saved instances, fetched by `method` page by page. Only one page of instances is kept in memory
+        '''
+        while True:
+            instances = list(method(offset=offset, count=count, **kwargs))
+            for instance in instances:
+                yield instance
+
+            if len(instances) < count:
+                break
+            offset += len(instances)
+
+    def get_method_name(self, method='get'):
+        '''
+        Return full name of API method the same way as VkontakteManager.api_call
+        '''
+        method = self.methods[method]
+        if self.model.methods_namespace:
+            method = self.model.methods_namespace + '.' + method
+        return method
+
+    def filter_timeline(self, instances, after=None, before=None, after_remote_id=None):
+        '''
+        Return list of instances with respect to parameters `after` and `before` the same way as VkontakteTimelineManager.fetch.
+        Items older than `after` or with ID on the wall not greater than `after_remote_id` end the timeline,
+        except pinned post, which is on the top of the wall independently of its date
+        '''
+        if self.timeline_force_ordering:
+            instances.sort(key=self.get_timeline_date, reverse=True)
+
+        result = []
+        for instance in instances:
+            timeline_date = self.get_timeline_date(instance)
+            if timeline_date and isinstance(timeline_date, datetime):
+                if before and before < timeline_date:
+                    continue
+                if after and after > timeline_date and not getattr(instance, '_pinned', False):
+                    break
+            if after_remote_id and not getattr(instance, '_pinned', False):
+                instance.parse_remote_id()
+                if instance.item_remote_id is not None and instance.item_remote_id <= after_remote_id:
+                    break
+            result += [instance]
+        return result
+
+    def get_or_create_from_instances(self, instances):
+        '''
+        Save list of instances with 2 queries for lookup of existing and inserting of new rows and batch of updates
+        '''
+        # the last instance with the same remote_id wins
+        instances = dict([(instance.remote_id, instance) for instance in instances])
+        if not instances:
+            return self.model.objects.none()
+
+        ids_existing = dict([(remote_id, (pk, raw_json_hash)) for remote_id, pk, raw_json_hash in self.model.objects.using(MASTER_DATABASE) \
+            .filter(remote_id__in=instances.keys()).values_list('remote_id', 'pk', 'raw_json_hash')])
+
+        instances_new = []
+        instances_existing = []
+        for remote_id, instance in instances.items():
+            if remote_id in ids_existing:
+                instance.pk, raw_json_hash = ids_existing[remote_id]
+                if instance.raw_json_hash and instance.raw_json_hash == raw_json_hash:
+                    continue
+                instances_existing += [instance]
+            else:
+                instances_new += [instance]
+            instance.prepare_save()
+
+        payloads = dict([(instance.remote_id, instance.pop_raw_payload()) for instance in instances_new + instances_existing])
+
+        self.model.objects.bulk_create(instances_new)
+        self.bulk_update(instances_existing)
+
+        if RAW_ARCHIVE:
+            ids = dict(self.model.objects.using(MASTER_DATABASE).filter(remote_id__in=[instance.remote_id for instance in instances_new]) \
+                .values_list('remote_id', 'pk'))
+            ids.update([(instance.remote_id, instance.pk) for instance in instances_existing])
+            self.save_raw_payloads(dict([(ids[remote_id], payload) for remote_id, payload in payloads.items() if payload]))
+
+        log.debug('Bulk saving of %s: %d created, %d updated, %d unchanged' % (self.model._meta.module_name, len(instances_new),
+                                                                              len(instances_existing), len(instances) - len(instances_new) - len(instances_existing)))
+
+        return self.model.objects.filter(remote_id__in=instances.keys())
+
+    def get_or_create_from_instance(self, instance):
+        '''
+        Skip saving of existing instance if response of API didn't change since the last fetching.
+        Unlike VkontakteManager.get_or_create_from_instance existing instance is selected with all fields,
+        not by lean default manager, so only really changed fields are updated
+        '''
+        if instance.raw_json_hash:
+            existing = self.model.objects.using(MASTER_DATABASE).filter(remote_id=instance.remote_id).values_list('pk', 'raw_json_hash')
+            if existing and existing[0][1] == instance.raw_json_hash:
+                instance.pk = existing[0][0]
+                vkontakte_api_post_fetch.send(sender=instance.__class__, instance=instance, created=False)
+                return instance
+
+        remote_pk_dict = dict([(field_name, getattr(instance, field_name)) for field_name in self.remote_pk])
+        old_instance = None
+        if remote_pk_dict:
+            try:
+                old_instance = self.model.objects.full().using(MASTER_DATABASE).get(**remote_pk_dict)
+                instance._substitute(old_instance)
+            except self.model.DoesNotExist:
+                log.debug('Fetch and create new object %s with remote pk %s' % (self.model, remote_pk_dict))
+        instance.save()
+
+        vkontakte_api_post_fetch.send(sender=instance.__class__, instance=instance, created=(not old_instance))
+        return instance
+
+    def bulk_update(self, instances):
+        '''
+        Update existing rows without calling save() and sending any signals.
+        Only changed columns of changed rows are written, raw_json is compared by raw_json_hash
+        '''
+        if not instances:
+            return
+        fields = [field for field in self.model._meta.local_fields if not field.primary_key and field.attname != 'raw_json']
+        field_raw_json = self.model._meta.get_field('raw_json')
+        pk_name = self.model._meta.pk.name
+        saved = dict([(values.pop(pk_name), values) for values in self.model.objects.using(MASTER_DATABASE) \
+            .filter(pk__in=[instance.pk for instance in instances]).values(pk_name, *[field.name for field in fields])])
+
+        rows = {}
+        for instance in instances:
+            changed = dict([(field, getattr(instance, field.attname)) for field in fields
+                            if field.to_python(saved[instance.pk][field.name]) != getattr(instance, field.attname)])
+            if 'raw_json_hash' in [field.name for field in changed]:
+                changed[field_raw_json] = instance.raw_json
+            if changed:
+                rows[instance.pk] = changed
+        self.update_rows(rows)
+
+    def update_rows(self, rows, chunk_size=100):
+        '''
+        Update columns of many rows with one UPDATE ... CASE query per chunk of rows.
+        Argument `rows` is dict {pk: {field: value}}, columns missing for a row keep their values
+        '''
+        qn = connection.ops.quote_name
+        pk_column = qn(self.model._meta.pk.column)
+        pks = rows.keys()
+        for i in range(0, len(pks), chunk_size):
+            chunk = pks[i:i + chunk_size]
+            fields = []
+            for pk in chunk:
+                fields += [field for field in rows[pk] if field not in fields]
+
+            columns = []
+            params = []
+            for field in fields:
+                pks_field = [pk for pk in chunk if field in rows[pk]]
+                columns += ['%s = CASE %s %s ELSE %s END' % (qn(field.column), pk_column, ' '.join(['WHEN %s THEN %s'] * len(pks_field)), qn(field.column))]
+                for pk in pks_field:
+                    params += [pk, field.get_db_prep_save(rows[pk][field], connection=connection)]
+
+            sql = 'UPDATE %s SET %s WHERE %s IN (%s)' % (qn(self.model._meta.db_table), ', '.join(columns), pk_column, ', '.join(['%s'] * len(chunk)))
+            connection.cursor().execute(sql, params + chunk)
+
+    def save_raw_payloads(self, payloads):
+        '''
+        Save payloads {pk: (raw_html, raw_json)} into the side table with one query for inserting of new rows.
+        Empty values don't overwrite saved ones
+        '''
+        raw_model = self.model.raw_model
+        pks_existing = set(raw_model.objects.filter(pk__in=payloads.keys()).values_list('pk', flat=True))
+        for pk in pks_existing:
+            raw_html, raw_json = payloads[pk]
+            values = dict([(name, value) for name, value in [('raw_html', raw_html), ('raw_json', raw_json)] if value])
+            raw_model.objects.filter(pk=pk).update(**values)
+
+        raw_model.objects.bulk_create([raw_model(instance_id=pk, raw_html=raw_html or '', raw_json=raw_json)
+                                       for pk, (raw_html, raw_json) in payloads.items() if pk not in pks_existing])
+
+    def get_or_create_groups_and_users(self, ids):
+        '''
+        Return dict of users and groups with signed remote ids as keys: positive for users, negative for groups.
+        Existing instances are selected with one query per model, missing ones are created in bulk.
+        Rows inserted by another worker between selecting and creating are selected again
+        '''
+        instances = {}
+        for model, sign in [(User, 1), (Group, -1)]:
+            remote_ids = set([abs(id) for id in ids if id and (id > 0) == (sign > 0)])
+            if not remote_ids:
+                continue
+
+            existing = list(model.objects.filter(remote_id__in=remote_ids))
+            remote_ids_missing = remote_ids.difference(set([instance.remote_id for instance in existing]))
+            if remote_ids_missing:
+                self.create_missing(model, remote_ids_missing)
+                existing += list(model.objects.filter(remote_id__in=remote_ids_missing))
+
+            for instance in existing:
+                instances[sign * instance.remote_id] = instance
+
+        return instances
+
+    def create_missing(self, model, remote_ids):
+        '''
+        Create instances of model with remote_ids in bulk. If another worker created some of them already,
+        bulk insert fails with IntegrityError and only rows still missing are created one by one
+        '''
+        if self.create_in_savepoint(model.objects.bulk_create, [model(remote_id=remote_id) for remote_id in remote_ids]):
+            return
+
+        remote_ids = set(remote_ids).difference(model.objects.filter(remote_id__in=remote_ids).values_list('remote_id', flat=True))
+        for remote_id in remote_ids:
+            if not self.create_in_savepoint(model.objects.create, remote_id=remote_id):
+                log.debug('%s with remote_id %s was created by another worker' % (model.__name__, remote_id))
+
+    def create_in_savepoint(self, method, *args, **kwargs):
+        '''
+        Call method inside savepoint, return False if it failed with IntegrityError, leaving transaction usable
+        '''
+        try:
+            with savepoint():
+                method(*args, **kwargs)
+            return True
+        except IntegrityError:
+            return False
+
+
+class PostRemoteManager(WallRemoteManager, ParseUsersMixin, ParseGroupsMixin):
 
     response_instances_fieldname = 'wall'
 
@@ -45,9 +467,123 @@ class PostRemoteManager(VkontakteTimelineManager, ParseUsersMixin, ParseGroupsMi
         else:
             return super(PostRemoteManager, self).parse_response_dict(resource, extra_fields)
 
+    def parse_response_list(self, response_list, extra_fields=None):
+        '''
+        Resolve owners and authors of all posts of the page at once and hand them to Post.parse
+        '''
+        ids = set()
+        for resource in response_list:
+            if isinstance(resource, dict):
+                ids.update([resource.get('to_id'), resource.get('from_id')])
+
+        extra_fields = dict(extra_fields or {})
+        extra_fields['_groups_and_users'] = self.get_or_create_groups_and_users(ids)
+
+        instances = super(PostRemoteManager, self).parse_response_list(response_list, extra_fields)
+        self.fetch_copy_owners(instances)
+        return instances
+
+    def fetch_copy_owners(self, instances):
+        '''
+        Fetch owners of original posts of all reposts of the page with one request per model instead of one request per post
+        '''
+        instances = [instance for instance in instances if instance.copy_owner_id and not instance.copy_owner_content_type_id]
+        for model, sign in [(User, 1), (Group, -1)]:
+            remote_ids = set([abs(instance.copy_owner_id) for instance in instances if (instance.copy_owner_id > 0) == (sign > 0)])
+            if not remote_ids:
+                continue
+
+            owners = dict([(owner.remote_id, owner) for owner in model.remote.fetch(ids=list(remote_ids))])
+            for instance in instances:
+                if (instance.copy_owner_id > 0) == (sign > 0) and abs(instance.copy_owner_id) in owners:
+                    instance.copy_owner = owners[abs(instance.copy_owner_id)]
+
+    def fetch_wall(self, owner, incremental=False, workers=None, **kwargs):
+        '''
+        Retrieve and save posts of the wall
+        Additional attributes:
+         * 'incremental' - fetch all posts, published since the last post of the previous incremental fetching.
+           Paging stops on the first already known post with ID not greater than the last one, kept in WallSyncState,
+           or on the first post older than the last known date for states without ID. Pinned post doesn't stop paging.
+         * 'workers' - with `all` fetch pages after the first one concurrently by this amount of threads.
+        '''
+        if not incremental:
+            if workers and kwargs.pop('all', False):
+                return self.fetch_pages_parallel(self.prepare_wall_kwargs, workers, owner=owner, **kwargs)
+            return self.fetch_wall_pages(owner=owner, **kwargs)
+
+        state = WallSyncState.objects.get_or_create(owner_content_type=ContentType.objects.get_for_model(owner), owner_id=owner.pk)[0]
+        if state.post_remote_id:
+            kwargs['after_remote_id'] = state.post_remote_id
+        elif state.post_date and not kwargs.get('after'):
+            kwargs['after'] = state.post_date
+        kwargs['all'] = True
+
+        log.debug('Fetching posts of owner "%s" incrementally after post %s, %s' % (owner, state.post_remote_id, kwargs.get('after')))
+
+        posts = self.fetch_wall(owner=owner, workers=workers, **kwargs)
+        state.update(posts)
+        return posts
+
     @transaction.commit_on_success
     @fetch_all(default_count=100)
-    def fetch_wall(self, owner, offset=0, count=100, filter='all', extended=False, before=None, after=None, **kwargs):
+    def fetch_wall_pages(self, owner, offset=0, count=100, filter='all', extended=False, before=None, after=None, bulk=False, **kwargs):
+        kwargs = self.prepare_wall_kwargs(owner, offset=offset, count=count, filter=filter, extended=extended, before=before, after=after, **kwargs)
+        kwargs['bulk'] = bulk
+
+        log.debug('Fetching posts of owner "%s", offset %d' % (owner, offset))
+
+        return self.fetch(**kwargs)
+
+    def iter_wall(self, owner, offset=0, count=100, **kwargs):
+        '''
+        Generator of saved posts of the wall, fetching them page by page
+        '''
+        return self.iter_pages(self.fetch_wall_pages, owner=owner, offset=offset, count=count, **kwargs)
+
+    def fetch_walls(self, owners, workers=None, **kwargs):
+        '''
+        Retrieve and save posts of walls of many owners, syncing each wall by fetch_wall with `kwargs`.
+        With `workers` walls are synced concurrently by this amount of threads, sharing the rate limiter of API requests.
+        Failure of one wall doesn't stop the others.
+        Return dict {owner: {'posts': amount of fetched posts, 'error': error message or None}}
+        '''
+        def sync(owner):
+            try:
+                return owner, {'posts': self.fetch_wall(owner=owner, **kwargs).count(), 'error': None}
+            except Exception, e:
+                log.error("Error while fetching wall of %s: %s" % (owner, e))
+                return owner, {'posts': 0, 'error': unicode(e)}
+            finally:
+                if workers:
+                    connection.close()
+
+        if not workers:
+            return dict(map(sync, owners))
+
+        pool = ThreadPool(workers)
+        try:
+            return dict(pool.map(sync, owners))
+        finally:
+            pool.terminate()
+
+    def fetch_walls_execute(self, owners, pages=1, offset=0, count=100, bulk=False, **kwargs):
+        '''
+        Fetch `pages` pages of walls of every owner starting from `offset`, packing up to 25 wall.get calls in one `execute` request
+        '''
+        calls_kwargs = []
+        for owner in owners:
+            for page in range(pages):
+                calls_kwargs += [self.prepare_wall_kwargs(owner, offset=offset + page * count, count=count, **kwargs)]
+
+        log.debug('Fetching %d pages of posts of %d owners via execute' % (pages, len(owners)))
+
+        return self.fetch_execute(calls_kwargs, bulk=bulk)
+
+    def prepare_wall_kwargs(self, owner, offset=0, count=100, filter='all', extended=False, before=None, after=None, **kwargs):
+        '''
+        Return kwargs of fetch method for one page of wall.get
+        '''
         if filter not in ['owner', 'others', 'all']:
             raise ValueError("Attribute 'fiter' has illegal value '%s'" % filter)
         if count > 100:
@@ -68,9 +604,7 @@ class PostRemoteManager(VkontakteTimelineManager, ParseUsersMixin, ParseGroupsMi
         kwargs['after'] = after
         kwargs['before'] = before
 
-        log.debug('Fetching posts of owner "%s", offset %d' % (owner, offset))
-
-        return self.fetch(**kwargs)
+        return kwargs
 
     @transaction.commit_on_success
     def fetch_group_wall_parser(self, group, offset=0, count=None, own=False, after=None):
@@ -87,19 +621,21 @@ class PostRemoteManager(VkontakteTimelineManager, ParseUsersMixin, ParseGroupsMi
 
         log.debug('Fetching post of group "%s", offset %d' % (group, offset))
 
-        parser = VkontakteWallParser().request('/wall-%s' % group.remote_id, data=post_data)
+        parser = VkontakteWallParser(defer_users_saving=True).request('/wall-%s' % group.remote_id, data=post_data)
 
-        items = parser.content_bs.findAll('div', {'class': re.compile('^post'), 'id': re.compile('^post-%d' % group.remote_id)})
+        items = parser.get_posts(group.remote_id)
 
         current_count = offset + len(items)
         need_cut = count and count < current_count
         if need_cut:
             items = items[:count - offset]
+        parser.resolve_slugs(items)
+        instances = parser.get_instances(Post, items)
 
         for item in items:
 
             try:
-                post = parser.parse_post(item, group)
+                post = parser.parse_post(item, group, instances)
             except VkontakteParseError, e:
                 log.error(e)
                 continue
@@ -108,10 +644,12 @@ class PostRemoteManager(VkontakteTimelineManager, ParseUsersMixin, ParseGroupsMi
                 need_cut = True
                 break
 
-            post.raw_html = unicode(item)
+            post.raw_html = parser.to_html(item)
             post.save()
             parsed.send(sender=Post, instance=post, container=item)
 
+        parser.save_users()
+
         if len(items) == 20 and not need_cut:
             return self.fetch_group_wall(group, offset=current_count, count=count, own=own, after=after)
         elif after:
@@ -120,11 +658,50 @@ class PostRemoteManager(VkontakteTimelineManager, ParseUsersMixin, ParseGroupsMi
             return group.wall_posts.all()
 
 
-class CommentRemoteManager(VkontakteTimelineManager):
+class CommentRemoteManager(WallRemoteManager):
+
+    def fetch_post(self, post, workers=None, **kwargs):
+        '''
+        Retrieve and save comments of the post
+        Additional attribute:
+         * 'workers' - with `all` fetch pages after the first one concurrently by this amount of threads.
+        '''
+        if workers and kwargs.pop('all', False):
+            return self.fetch_pages_parallel(self.prepare_post_kwargs, workers, post=post, **kwargs)
+        return self.fetch_post_pages(post=post, **kwargs)
 
     @transaction.commit_on_success
     @fetch_all(default_count=100)
-    def fetch_post(self, post, offset=0, count=100, sort='asc', need_likes=True, preview_length=0, before=None, after=None, **kwargs):
+    def fetch_post_pages(self, post, offset=0, count=100, sort='asc', need_likes=True, preview_length=0, before=None, after=None, **kwargs):
+        kwargs = self.prepare_post_kwargs(post, offset=offset, count=count, sort=sort, need_likes=need_likes, preview_length=preview_length, before=before, after=after, **kwargs)
+
+        log.debug('Fetching comments to post "%s" of owner "%s", offset %d' % (post.remote_id, post.wall_owner, offset))
+
+        return self.fetch(**kwargs)
+
+    def iter_comments(self, post, offset=0, count=100, **kwargs):
+        '''
+        Generator of saved comments of the post, fetching them page by page
+        '''
+        return self.iter_pages(self.fetch_post_pages, post=post, offset=offset, count=count, **kwargs)
+
+    def fetch_posts_execute(self, posts, pages=1, offset=0, count=100, bulk=False, **kwargs):
+        '''
+        Fetch `pages` pages of comments of every post starting from `offset`, packing up to 25 wall.getComments calls in one `execute` request
+        '''
+        calls_kwargs = []
+        for post in posts:
+            for page in range(pages):
+                calls_kwargs += [self.prepare_post_kwargs(post, offset=offset + page * count, count=count, **kwargs)]
+
+        log.debug('Fetching %d pages of comments to %d posts via execute' % (pages, len(posts)))
+
+        return self.fetch_execute(calls_kwargs, bulk=bulk)
+
+    def prepare_post_kwargs(self, post, offset=0, count=100, sort='asc', need_likes=True, preview_length=0, before=None, after=None, **kwargs):
+        '''
+        Return kwargs of fetch method for one page of wall.getComments
+        '''
         if count > 100:
             raise ValueError("Attribute 'count' can not be more than 100")
         if sort not in ['asc', 'desc']:
@@ -138,12 +715,10 @@ class CommentRemoteManager(VkontakteTimelineManager):
 
         # owner_id
         # идентификатор пользователя, на чьей стене находится запись, к которой необходимо получить комментарии. Если параметр не задан, то он считается равным идентификатору текущего пользователя.
-        kwargs['owner_id'] = post.wall_owner.remote_id
-        if isinstance(post.wall_owner, Group):
-            kwargs['owner_id'] *= -1
+        kwargs['owner_id'] = post.remote_owner_id
         # post_id
         # идентификатор записи на стене пользователя.
-        kwargs['post_id'] = post.remote_id.split('_')[1]
+        kwargs['post_id'] = post.remote_id_short
         # sort
         # порядок сортировки комментариев:
         # asc - хронологический
@@ -164,13 +739,69 @@ class CommentRemoteManager(VkontakteTimelineManager):
         # v
         # Данный метод может возвращать разные результаты в зависимости от используемой версии. Передавайте v=4.4 для того, чтобы получать аттачи в комментариях в виде объектов, а не ссылок.
 
-        kwargs['extra_fields'] = {'post_id': post.id}
+        # post instance is put into cache of the foreign key to avoid selecting it for each comment
+        kwargs['extra_fields'] = {'post_id': post.id, '_post_cache': post}
         kwargs['before'] = before
         kwargs['after'] = after
 
-        log.debug('Fetching comments to post "%s" of owner "%s", offset %d' % (post.remote_id, post.wall_owner, offset))
+        return kwargs
 
-        return self.fetch(**kwargs)
+    def parse_response_list(self, response_list, extra_fields=None):
+        '''
+        Resolve authors, users and comments replied to of all comments of the page at once and hand them to Comment.parse
+        '''
+        resources = [resource for resource in response_list if isinstance(resource, dict)]
+        extra_fields = dict(extra_fields or {})
+
+        ids = set()
+        for resource in resources:
+            ids.update([resource.get('uid'), resource.get('reply_to_uid')])
+        extra_fields['_groups_and_users'] = self.get_or_create_groups_and_users(ids)
+
+        post = extra_fields.get('_post_cache')
+        if post:
+            owner_id = post.remote_owner_id
+            item_ids = [int(resource['reply_to_cid']) for resource in resources if 'reply_to_cid' in resource]
+            extra_fields['_reply_to_ids'] = dict([('%s_%s' % (owner_id, item_id), pk) for item_id, pk in self.model.objects \
+                .filter(owner_remote_id=owner_id, item_remote_id__in=item_ids).values_list('item_remote_id', 'pk')]) if item_ids else {}
+
+        instances = super(CommentRemoteManager, self).parse_response_list(response_list, extra_fields)
+
+        # replies to comments of the same page, which are not in DB yet
+        instances_page = dict([(instance.remote_id, instance) for instance in instances])
+        for instance in instances:
+            reply_to = instances_page.get(getattr(instance, '_reply_to_remote_id', None))
+            if reply_to and not instance.reply_to_id:
+                instance.reply_to = reply_to
+                reply_to._page_replies = getattr(reply_to, '_page_replies', []) + [instance]
+
+        return instances
+
+    def get_or_create_from_instances(self, instances):
+        '''
+        After saving in bulk link replies to comments, which were not in DB while parsing, with one UPDATE query
+        '''
+        result = super(CommentRemoteManager, self).get_or_create_from_instances(instances)
+
+        replies = [instance for instance in instances if getattr(instance, '_reply_to_remote_id', None) and not instance.reply_to_id]
+        if replies:
+            ids = [tuple(map(int, remote_id.split('_'))) for remote_id in
+                   [reply.remote_id for reply in replies] + [reply._reply_to_remote_id for reply in replies]]
+            pks = dict([((owner_id, item_id), pk) for owner_id, item_id, pk in self.model.objects.using(MASTER_DATABASE) \
+                .filter(owner_remote_id__in=set([id[0] for id in ids]), item_remote_id__in=set([id[1] for id in ids])) \
+                .values_list('owner_remote_id', 'item_remote_id', 'pk')])
+
+            field = self.model._meta.get_field('reply_to')
+            rows = {}
+            for reply in replies:
+                pk = pks.get(tuple(map(int, reply.remote_id.split('_'))))
+                reply_to_pk = pks.get(tuple(map(int, reply._reply_to_remote_id.split('_'))))
+                if pk and reply_to_pk:
+                    rows[pk] = {field: reply_to_pk}
+                    reply.reply_to_id = reply_to_pk
+            self.update_rows(rows)
+
+        return result
 
     @transaction.commit_on_success
     def fetch_group_post_parser(self, post, offset=0, count=None):  # jkj, after=None, only_new=False):
@@ -185,14 +816,16 @@ class CommentRemoteManager(VkontakteTimelineManager):
 
         log.debug('Fetching comments to post "%s" of owner "%s", offset %d' % (post.remote_id, post.wall_owner, offset))
 
-        parser = VkontakteWallParser().request('/wall%s' % (post.remote_id), data=post_data)
+        parser = VkontakteWallParser(defer_users_saving=True).request('/wall%s' % (post.remote_id), data=post_data)
 
-        items = parser.content_bs.findAll('div', {'class': 'fw_reply'})
+        items = parser.get_comments()
 
         current_count = offset + len(items)
         need_cut = count and count < current_count
         if need_cut:
             items = items[:count - offset]
+        parser.resolve_slugs(items)
+        instances = parser.get_instances(Comment, items)
 
 #        # get date of last comment and set after attribute
 #        if only_new:
@@ -203,13 +836,13 @@ class CommentRemoteManager(VkontakteTimelineManager):
         for item in items:
 
             try:
-                comment = parser.parse_comment(item, post.wall_owner)
+                comment = parser.parse_comment(item, post.wall_owner, instances)
             except VkontakteParseError, e:
                 log.error(e)
                 continue
 
             comment.post = post
-            comment.raw_html = unicode(item)
+            comment.raw_html = parser.to_html(item)
             comment.save()
             parsed.send(sender=Comment, instance=comment, container=item)
 
@@ -217,6 +850,8 @@ class CommentRemoteManager(VkontakteTimelineManager):
 #                need_cut = True
 #                break
 
+        parser.save_users()
+
         if len(items) == 20 and not need_cut:
             return self.fetch_group_post(post, offset=current_count, count=count)  # , after=after, only_new=only_new)
 #        elif after and need_cut:
@@ -236,12 +871,19 @@ class WallAbstractModel(VkontakteModel, VkontakteCRUDModel):
     slug_prefix = 'wall'
     generic_fields_models_allowed = [Group, User]
     _commit_remote = False
+    # heavy fields, not loaded by querysets of default manager
+    lean_deferred_fields = ['raw_html', 'raw_json']
 
     remote_id = models.CharField(u'ID', max_length='20', help_text=u'Уникальный идентификатор', unique=True)
+    # parts of remote_id: signed ID of owner of the wall and ID of post or comment on the wall
+    owner_remote_id = models.IntegerField(u'ID владельца стены', null=True)
+    item_remote_id = models.PositiveIntegerField(u'ID на стене', null=True)
 
     # only for posts/comments from parser
-    raw_html = models.TextField()
-    raw_json = fields.JSONField(default={}, null=True)
+    raw_html = CompressedTextField()
+    raw_json = CompressedJSONField(default={}, null=True)
+    # md5 of raw_json for skipping saving of unchanged instances
+    raw_json_hash = models.CharField(max_length=32, default='')
 
     @property
     def slug(self):
@@ -249,22 +891,25 @@ class WallAbstractModel(VkontakteModel, VkontakteCRUDModel):
 
     @property
     def on_group_wall(self):
-        return self.wall_owner_content_type == ContentType.objects.get_for_model(Group)
+        return self.wall_owner_content_type_id == get_content_type_id(Group)
 
     @property
     def on_user_wall(self):
-        return self.wall_owner_content_type == ContentType.objects.get_for_model(User)
+        return self.wall_owner_content_type_id == get_content_type_id(User)
 
     @property
     def by_group(self):
-        return self.author_content_type == ContentType.objects.get_for_model(Group)
+        return self.author_content_type_id == get_content_type_id(Group)
 
     @property
     def by_user(self):
-        return self.author_content_type == ContentType.objects.get_for_model(User)
+        return self.author_content_type_id == get_content_type_id(User)
 
     @property
     def remote_owner_id(self):
+        # owner is not selected from DB, if it's not loaded yet
+        if self.owner_remote_id is not None and getattr(self, '_wall_owner_cache', None) is None:
+            return self.owner_remote_id
         owner_id = self.wall_owner.remote_id
         if isinstance(self.wall_owner, Group) and owner_id > 0:
             owner_id *= -1
@@ -272,27 +917,153 @@ class WallAbstractModel(VkontakteModel, VkontakteCRUDModel):
 
     @property
     def remote_id_short(self):
+        if self.item_remote_id is not None:
+            return str(self.item_remote_id)
         return self.remote_id.split('_')[1]
 
+    def __init__(self, *args, **kwargs):
+        super(WallAbstractModel, self).__init__(*args, **kwargs)
+        # values of fields, saved in DB, for updating only changed ones
+        self._fields_saved = self.get_fields_values() if self.pk else None
+
+    def __eq__(self, other):
+        # instances of deferred classes, made by lean querysets, are equal to instances of the model
+        return isinstance(other, models.Model) and self._meta.concrete_model == other._meta.concrete_model and self.pk == other.pk
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def _substitute(self, old_instance):
+        super(WallAbstractModel, self)._substitute(old_instance)
+        self._fields_saved = old_instance._fields_saved
+
     def save(self, *args, **kwargs):
+        self.prepare_save()
+
+        commit_remote = kwargs.get('commit_remote', args[0] if args else None)
+        commit_remote = commit_remote if commit_remote is not None else self._commit_remote
+        # update_fields is supported since Django 1.5, kwargs are passed to remote methods while committing remote
+        if self.pk and self._fields_saved is not None and not commit_remote and django.VERSION >= (1, 5) \
+                and not set(['update_fields', 'force_insert', 'force_update']).intersection(kwargs):
+            kwargs['update_fields'] = self.get_fields_changed()
+
+        payload = self.pop_raw_payload()
+        result = super(WallAbstractModel, self).save(*args, **kwargs)
+        if payload:
+            self.__class__.remote.save_raw_payloads({self.pk: payload})
+            self.raw_html, self.raw_json = payload
+        self._fields_saved = self.get_fields_values()
+        return result
+
+    def get_fields_values(self):
+        '''
+        Return dict of values of loaded fields. Large raw_json is represented by raw_json_hash
+        '''
+        return dict([(field.attname, self.__dict__[field.attname]) for field in self._meta.fields
+                     if not field.primary_key and field.attname != 'raw_json' and field.attname in self.__dict__])
+
+    def get_fields_changed(self):
+        '''
+        Return list of names of fields, changed since loading from DB or the last saving
+        '''
+        changed = [field.name for field in self._meta.fields if field.attname in self.__dict__ and not field.primary_key
+                   and field.attname != 'raw_json' and self.is_field_changed(field)]
+        if 'raw_json_hash' in changed:
+            changed += ['raw_json']
+        return changed
+
+    def is_field_changed(self, field):
+        '''
+        Compare value of field with saved one. Values like dicts in text fields are compared as they are saved to DB
+        '''
+        value_saved = self._fields_saved.get(field.attname, FIELD_NOT_LOADED)
+        value = self.__dict__[field.attname]
+        if value_saved is FIELD_NOT_LOADED:
+            return True
+        if value_saved == value:
+            return False
+        try:
+            return field.get_prep_value(value_saved) != field.get_prep_value(value)
+        except Exception:
+            return True
+
+    def prepare_save(self):
+        '''
+        Prepare instance for saving to DB. Called also before saving instances in bulk, when save() is not called
+        '''
+        self.parse_remote_id()
         self.prepare_generic_fields()
-        return super(WallAbstractModel, self).save(*args, **kwargs)
+        self.update_raw_json_hash()
+
+    def parse_remote_id(self):
+        '''
+        Set integer owner_remote_id and item_remote_id from remote_id like "-16297716_126261"
+        '''
+        parts = str(self.remote_id or '').split('_')
+        if len(parts) > 1:
+            self.owner_remote_id, self.item_remote_id = int(parts[0]), int(parts[-1])
+
+    def pop_raw_payload(self):
+        '''
+        If raw payloads are stored in the side table, return tuple (raw_html, raw_json) and clear them in the row
+        '''
+        if not RAW_ARCHIVE or not (self.raw_html or self.raw_json):
+            return None
+        payload = (self.raw_html, self.raw_json)
+        self.raw_html, self.raw_json = '', None
+        return payload
+
+    def get_raw_payload(self):
+        '''
+        Return object with raw_html and raw_json attributes: row of the side table or instance itself.
+        The side table is queried only here
+        '''
+        if RAW_ARCHIVE:
+            try:
+                return self.raw
+            except ObjectDoesNotExist:
+                pass
+        return self
+
+    def parse_raw_json(self, response):
+        '''
+        Keep copy of API response and its hash
+        '''
+        self.raw_json = dict(response)
+        self.update_raw_json_hash()
+
+    def update_raw_json_hash(self):
+        '''
+        Recalculate hash of raw_json, if it was assigned or accessed, so changed raw_json is saved. Hash of empty value is empty
+        '''
+        value = self.__dict__.get('raw_json')
+        if isinstance(value, (dict, list)):
+            self.raw_json_hash = hashlib.md5(json.dumps(value, sort_keys=True)).hexdigest() if value else ''
 
     def prepare_generic_fields(self):
         '''
         Check and set exactly right Group or User content types, not content type of a child
         '''
-        allowed_ct_pks = [ct.pk for ct in ContentType.objects.get_for_models(*self.generic_fields_models_allowed).values()]
+        allowed_ct_ids = [get_content_type_id(model) for model in self.generic_fields_models_allowed]
         for field_name in self.generic_field_names:
-            ct_field_name = '%s_content_type' % field_name
-            for allowed_model in self.generic_fields_models_allowed:
-                if isinstance(getattr(self, field_name), allowed_model):
-                    setattr(self, ct_field_name, ContentType.objects.get_for_model(allowed_model))
-                    break
-            if getattr(self, field_name) and getattr(self, ct_field_name).pk not in allowed_ct_pks:
-                raise AttributeError("Attribute '%s' field should be any of %s instance, but not %s" % (field_name, allowed_models, getattr(self, field_name)))
+            ct_id_field_name = '%s_content_type_id' % field_name
+            # only assigned instances are checked, not assigned fields are not loaded from DB
+            instance = getattr(self, '_%s_cache' % field_name, None)
+            if instance is not None:
+                for allowed_model in self.generic_fields_models_allowed:
+                    if isinstance(instance, allowed_model):
+                        ct_id = get_content_type_id(allowed_model)
+                        if getattr(self, ct_id_field_name) != ct_id:
+                            setattr(self, '%s_content_type' % field_name, ContentType.objects.get_for_id(ct_id))
+                        break
+            if getattr(self, ct_id_field_name) and getattr(self, ct_id_field_name) not in allowed_ct_ids:
+                raise AttributeError("Attribute '%s' field should be any of %s instance, but not %s" % (field_name, self.generic_fields_models_allowed, getattr(self, field_name)))
 
     def get_or_create_group_or_user(self, remote_id):
+        # instances, resolved in advance for the whole page of response by remote manager
+        if remote_id in getattr(self, '_groups_and_users', {}):
+            return (self._groups_and_users[remote_id], False)
+
         if remote_id > 0:
             Model = User
         elif remote_id < 0:
@@ -307,22 +1078,23 @@ class WallAbstractModel(VkontakteModel, VkontakteCRUDModel):
 
 #        kwargs['offset'] = int(kwargs.pop('offset', 0))
         kwargs['likes_type'] = self.likes_type
-        kwargs['item_id'] = self.remote_id.split('_')[1]
-        kwargs['owner_id'] = self.wall_owner.remote_id
-        if isinstance(self.wall_owner, Group):
-            kwargs['owner_id'] *= -1
+        kwargs['item_id'] = self.remote_id_short
+        kwargs['owner_id'] = self.remote_owner_id
 
         log.debug('Fetching likes of %s %s of owner "%s"' % (self._meta.module_name, self.remote_id, self.wall_owner))
 
         ids = User.remote.fetch_likes_user_ids(*args, **kwargs)
         if not ids:
             return User.objects.none()
+        ids = set(ids)
+
+        # fetch new and expired users
+        User.remote.fetch(ids=ids, only_expired=True)
 
-        # fetch users
-        self.like_users = User.remote.fetch(ids=ids, only_expired=True)
+        self.update_like_users(ids)
 
         # update self.likes
-        likes_count = self.like_users.count()
+        likes_count = len(ids)
         if likes_count < self.likes:
             log.warning('Fetched ammount of like users less, than attribute `likes` of post "%s": %d < %d' % (self.remote_id, likes_count, self.likes))
         self.likes = likes_count
@@ -330,15 +1102,35 @@ class WallAbstractModel(VkontakteModel, VkontakteCRUDModel):
 
         return self.like_users.all()
 
+    def update_like_users(self, ids):
+        '''
+        Update history of like users by difference between current and new ids.
+        Manager of ManyToManyHistoryField adds and removes all of them in bulk with one time and sends m2m_changed signals
+        '''
+        manager = self.like_users
+        ids_current = set(manager.get_query_set(only_pk=True).using(MASTER_DATABASE))
+        # only users existing in DB
+        ids_add = User.objects.filter(pk__in=ids.difference(ids_current)).values_list('pk', flat=True)
+        ids_remove = ids_current.difference(ids)
+
+        if ids_add:
+            manager.add(*ids_add)
+        if ids_remove:
+            manager.remove(*ids_remove)
+
 
 class Post(WallAbstractModel):
     class Meta:
         verbose_name = u'Сообщение Вконтакте'
         verbose_name_plural = u'Сообщения Вконтакте'
+        # composite index (wall_owner_content_type, wall_owner_id, date) for timelines of walls is created by migration 0019,
+        # not by index_together, which is not supported by Django 1.4
+        unique_together = ('owner_remote_id', 'item_remote_id')
 
     likes_type = 'post'
     fields_required_for_update = ['post_id', 'owner_id']
     generic_field_names = ['author', 'wall_owner', 'copy_owner']
+    lean_deferred_fields = WallAbstractModel.lean_deferred_fields + ['attachments', 'media', 'geo', 'copy_text']
 
     # Владелец стены сообщения User or Group
     wall_owner_content_type = models.ForeignKey(ContentType, related_name='vkontakte_wall_posts')
@@ -415,7 +1207,7 @@ class Post(WallAbstractModel):
     online = models.PositiveSmallIntegerField(null=True)
     reply_count = models.PositiveIntegerField(null=True)
 
-    objects = VkontakteCRUDManager()
+    objects = WallManager()
     remote = PostRemoteManager(remote_pk=('remote_id',), methods={
         'get': 'get',
         'getById': 'getById',
@@ -432,7 +1224,7 @@ class Post(WallAbstractModel):
     def __unicode__(self):
         return '%s: %s' % (unicode(self.wall_owner), self.text)
 
-    def save(self, *args, **kwargs):
+    def prepare_save(self):
         # check strings for good encoding
         # there is problems to save users with bad encoded activity strings like user ID=88798245
 
@@ -441,17 +1233,19 @@ class Post(WallAbstractModel):
 #        except UnicodeDecodeError:
 #            self.text = ''
 
-        # поле назначено через API
-        if self.copy_owner_id and not self.copy_owner_content_type:
+        # поле назначено через API, но не получено в PostRemoteManager.fetch_copy_owners
+        if self.copy_owner_id and not self.copy_owner_content_type_id:
             ct_model = User if self.copy_owner_id > 0 else Group
             self.copy_owner_content_type = ContentType.objects.get_for_model(ct_model)
             self.copy_owner = ct_model.remote.fetch(ids=[abs(self.copy_owner_id)])[0]
 
-        # save generic fields before saving post
-        if self.copy_owner:
-            self.copy_owner.save()
+        # save generic field before saving post, only if it's a new instance
+        copy_owner = getattr(self, '_copy_owner_cache', None)
+        if copy_owner and not copy_owner.pk:
+            copy_owner.save()
+            self.copy_owner = copy_owner
 
-        return super(Post, self).save(*args, **kwargs)
+        super(Post, self).prepare_save()
 
     def prepare_create_params(self, **kwargs):
         kwargs.update({
@@ -485,13 +1279,15 @@ class Post(WallAbstractModel):
         return None
 
     def parse(self, response):
-        self.raw_json = dict(response)
+        self.parse_raw_json(response)
+        # pinned post is the first on the wall, but it can be older than the others
+        self._pinned = bool(response.pop('is_pinned', False))
 
         for field_name in ['comments', 'likes', 'reposts']:
             if field_name in response and 'count' in response[field_name]:
                 setattr(self, field_name, response.pop(field_name)['count'])
 
-        # TODO: may we should move this to save and keep parse queryless
+        # owners and authors are resolved for the whole page by PostRemoteManager.parse_response_list
         self.wall_owner = self.get_or_create_group_or_user(response.pop('to_id'))[0]
         self.author = self.get_or_create_group_or_user(response.pop('from_id'))[0]
 
@@ -516,6 +1312,7 @@ class Post(WallAbstractModel):
         super(Post, self).parse(response)
 
         self.remote_id = '%s%s_%s' % (('-' if self.on_group_wall else ''), self.wall_owner.remote_id, self.remote_id)
+        self.parse_remote_id()
 
     def fetch_comments(self, *args, **kwargs):
         return Comment.remote.fetch_post(post=self, *args, **kwargs)
@@ -528,40 +1325,13 @@ class Post(WallAbstractModel):
             return self.fetch_likes_parser(*args, **kwargs)
 
     @transaction.commit_on_success
-    def fetch_likes_parser(self, offset=0):
+    def fetch_likes_parser(self, offset=0, workers=None):
         '''
         Update and save fields:
             * likes - count of likes
         Update relations:
             * like_users - users, who likes this post
         '''
-        post_data = {
-            'act': 'show',
-            'al': 1,
-            'w': 'likes/wall%s' % self.remote_id,
-        }
-
-        if offset == 0:
-            number_on_page = 120
-            post_data['loc'] = 'wall%s' % self.remote_id,
-        else:
-            number_on_page = 60
-            post_data['offset'] = offset
-
-        log.debug('Fetching likes of post "%s" of owner "%s", offset %d' % (self.remote_id, self.wall_owner, offset))
-
-        parser = VkontakteWallParser().request('/wkview.php', data=post_data)
-
-        if offset == 0:
-            try:
-                self.likes = int(parser.content_bs.find('a', {'id': 'wk_likes_tablikes'}).find('nobr').text.split()[0])
-                self.save()
-            except ValueError:
-                return
-            except:
-                log.warning('Strange markup of first page likes response: "%s"' % parser.content)
-            self.like_users.clear()
-
         #<div class="wk_likes_liker_row inl_bl" id="wk_likes_liker_row722246">
         #  <div class="wk_likes_likerph_wrap" onmouseover="WkView.likesBigphOver(this, 722246)">
         #    <a class="wk_likes_liker_ph" href="/kicolenka">
@@ -571,15 +1341,71 @@ class Post(WallAbstractModel):
         #  <div class="wk_likes_liker_name"><a class="wk_likes_liker_lnk" href="/kicolenka">Оля Киселева</a></div>
         #</div>
 
-        items = parser.add_users(users=('div', {'class': re.compile(r'^wk_likes_liker_row')}),
+        return self.fetch_users_parser('likes', 'like_users', 'likes', numbers_on_page=(120, 60), offset=offset, workers=workers,
+            users=('div', {'class': re.compile(r'^wk_likes_liker_row')}),
             user_link=('a', {'class': 'wk_likes_liker_lnk'}),
-            user_photo=('img', {'class': 'wk_likes_liker_img'}),
-            user_add=lambda user: self.like_users.add(user))
+            user_photo=('img', {'class': 'wk_likes_liker_img'}))
 
-        if len(items) == number_on_page:
-            self.fetch_likes_parser(offset=offset + number_on_page)
-        else:
-            return self.like_users.all()
+    def fetch_users_parser(self, tab, field_name, counter_name, numbers_on_page, offset=0, workers=None, **add_users_kwargs):
+        '''
+        Fetch users of likes or shares tab of the post page by page, adding users of each page to relation `field_name` at once.
+        Argument `numbers_on_page` is a tuple of amounts of users on the first and the following pages.
+        With `workers` pages after the first one are requested concurrently by this amount of threads
+        using total count of users from the first page, but parsed and saved in order in the calling thread
+        '''
+        manager = getattr(self, field_name)
+
+        def request(offset):
+            post_data = {
+                'act': 'show',
+                'al': 1,
+                'w': '%s/wall%s' % (tab, self.remote_id),
+            }
+            if offset == 0:
+                post_data['loc'] = 'wall%s' % self.remote_id
+            else:
+                post_data['offset'] = offset
+
+            log.debug('Fetching %s of post "%s" of owner "%s", offset %d' % (tab, self.remote_id, self.wall_owner, offset))
+
+            return VkontakteWallParser().request('/wkview.php', data=post_data)
+
+        def add_users(parser):
+            users = []
+            items = parser.add_users(user_add=lambda user: users.append(user), **add_users_kwargs)
+            if users:
+                manager.add(*users)
+            return items
+
+        parser = request(offset)
+        if offset == 0:
+            try:
+                setattr(self, counter_name, int(parser.content_bs.find('a', {'id': 'wk_likes_tab%s' % tab}).find('nobr').text.split()[0]))
+                self.save()
+            except ValueError:
+                return
+            except:
+                log.warning('Strange markup of first page %s response: "%s"' % (tab, parser.content))
+            manager.clear()
+
+        number_on_page = numbers_on_page[0] if offset == 0 else numbers_on_page[1]
+        if len(add_users(parser)) == number_on_page:
+            offset += number_on_page
+            number_on_page = numbers_on_page[1]
+
+            if workers and getattr(self, counter_name):
+                pool = ThreadPool(workers)
+                try:
+                    for parser in pool.imap(request, range(offset, getattr(self, counter_name), number_on_page)):
+                        if len(add_users(parser)) < number_on_page:
+                            break
+                finally:
+                    pool.terminate()
+            else:
+                while len(add_users(request(offset))) == number_on_page:
+                    offset += number_on_page
+
+        return manager.all()
 
     def fetch_reposts(self, source='api', *args, **kwargs):
         if source == 'api':
@@ -601,14 +1427,21 @@ class Post(WallAbstractModel):
 
     @transaction.commit_on_success
     def fetch_instance_reposts(self, *args, **kwargs):
+        '''
+        Update history of repost users. With `staging=True` reposts are handled page by page
+        through temporary table and compared with current ones in DB by method fetch_instance_reposts_staging.
+        With `store_posts=True` reposts of users and groups are saved as posts of their walls by save_repost_posts
+        '''
+        store_posts = kwargs.pop('store_posts', False)
+        if kwargs.pop('staging', False):
+            return self.fetch_instance_reposts_staging(store_posts=store_posts, **kwargs)
 
         resources = self.fetch_repost_items(*args, **kwargs)
         if not resources:
             return Post.objects.none()
 
-        # TODO: still complicated to store reposts objects, may be it's task for another application
-#         posts = Post.remote.parse_response(resources)#, extra_fields={'copy_post_id': self.pk})
-#         return Post.objects.filter(pk__in=set([Post.remote.get_or_create_from_instance(instance).pk for instance in posts]))
+        if store_posts:
+            self.save_repost_posts(resources)
 
         # positive ids -> only users
         # TODO: think about how to store reposts by groups
@@ -635,6 +1468,111 @@ class Post(WallAbstractModel):
 #        m2m_model.objects.filter(post_id=self.pk, user_id__in=ids_remove).update(time_to=datetime.now())
         return
 
+    def fetch_instance_reposts_staging(self, offset=0, count=1000, store_posts=False, **kwargs):
+        '''
+        Update history of repost users without keeping all of them in memory: (user_id, date) pairs of every page
+        are copied to temporary table (COPY on PostgreSQL, executemany on other backends),
+        new reposts are inserted and removed ones are closed by set-based SQL queries
+        '''
+        kwargs.pop('all', None)
+        cursor = connection.cursor()
+        qn = connection.ops.quote_name
+
+        m2m_model = self.repost_users.through
+        params = {
+            'staging': 'vkontakte_wall_reposts_staging',
+            'm2m': qn(m2m_model._meta.db_table),
+            'post_id': qn('%s_id' % self.repost_users.source_field_name),
+            'user_id': qn('%s_id' % self.repost_users.target_field_name),
+            'users': qn(User._meta.db_table),
+            'users_pk': qn(User._meta.pk.column),
+        }
+
+        cursor.execute('CREATE TEMPORARY TABLE %(staging)s (user_id %(user_type)s, date %(date_type)s)' % dict(params,
+            user_type=connection.creation.data_types['BigIntegerField'], date_type=connection.creation.data_types['DateTimeField']))
+        try:
+            # failed statement is rolled back to savepoint, otherwise PostgreSQL refuses to drop the table in aborted transaction
+            with savepoint():
+                self.update_reposts_staging(cursor, params, offset, count, store_posts, **kwargs)
+        finally:
+            cursor.execute('DROP TABLE %(staging)s' % params)
+
+    def update_reposts_staging(self, cursor, params, offset, count, store_posts, **kwargs):
+        '''
+        Fetch reposts into temporary table and update history of repost users by it
+        '''
+        # paging the same way as fetch_all decorator, including extra calls because of the bug of reposts pagination
+        extra_calls = 0
+        staged = 0
+        while True:
+            items = self.fetch_repost_items(offset=offset, count=count, **kwargs)
+            if items:
+                if store_posts:
+                    self.save_repost_posts(items)
+                # positive ids -> only users
+                rows = [(item['from_id'], datetime.fromtimestamp(item['date'])) for item in items if item['from_id'] > 0]
+                self.stage_reposts(cursor, params['staging'], rows)
+                staged += len(rows)
+                offset += len(items)
+            elif extra_calls < 3:
+                offset += 1
+                extra_calls += 1
+            else:
+                break
+
+        # remove old reposts without time_from
+        self.repost_users.get_query_set_through().filter(time_from=None).delete()
+
+        # fetch new users
+        cursor.execute('''SELECT DISTINCT s.user_id FROM %(staging)s s WHERE NOT EXISTS
+            (SELECT 1 FROM %(m2m)s t WHERE t.%(post_id)s = %%s AND t.%(user_id)s = s.user_id AND t.time_to IS NULL)''' % params, [self.pk])
+        ids_add = [row[0] for row in cursor.fetchall()]
+        if ids_add:
+            User.remote.fetch(ids=ids_add, only_expired=True)
+
+        # add new reposts of existing users
+        cursor.execute('''INSERT INTO %(m2m)s (%(post_id)s, %(user_id)s, time_from)
+            SELECT %%s, s.user_id, MAX(s.date) FROM %(staging)s s INNER JOIN %(users)s u ON u.%(users_pk)s = s.user_id
+            WHERE NOT EXISTS (SELECT 1 FROM %(m2m)s t WHERE t.%(post_id)s = %%s AND t.%(user_id)s = s.user_id AND t.time_to IS NULL)
+            GROUP BY s.user_id''' % params, [self.pk, self.pk])
+
+        # close removed reposts, but not all of them if API returned nothing
+        if staged:
+            cursor.execute('''UPDATE %(m2m)s SET time_to = %%s WHERE %(post_id)s = %%s AND time_to IS NULL
+                AND NOT EXISTS (SELECT 1 FROM %(staging)s s WHERE s.user_id = %(m2m)s.%(user_id)s)''' % params,
+                [connection.ops.value_to_db_datetime(self.repost_users.get_time()), self.pk])
+
+    def save_repost_posts(self, resources):
+        '''
+        Save items of wall.getReposts response as posts of walls of reposted users and groups in bulk, linked to this post by copy_post
+        '''
+        resources = [dict(resource) for resource in resources]
+        for resource in resources:
+            # all items are copies of this post
+            resource.pop('copy_owner_id', None)
+            resource.pop('copy_post_id', None)
+
+        extra_fields = {
+            'copy_post_id': self.pk,
+            '_copy_post_cache': self,
+            'copy_owner_content_type_id': self.wall_owner_content_type_id,
+            'copy_owner_id': self.wall_owner_id,
+            'fetched': datetime.now(),
+        }
+        return Post.remote.get_or_create_from_instances(Post.remote.parse_response_list(resources, extra_fields))
+
+    def stage_reposts(self, cursor, table, rows):
+        '''
+        Insert rows of reposts into temporary table
+        '''
+        if not rows:
+            return
+        if connection.vendor == 'postgresql':
+            cursor.cursor.copy_from(StringIO(''.join(['%s\t%s\n' % (user_id, date.isoformat(' ')) for user_id, date in rows])),
+                                    table, columns=('user_id', 'date'))
+        else:
+            cursor.executemany('INSERT INTO %s (user_id, date) VALUES (%%s, %%s)' % table, rows)
+
     # не рекомендуется указывать default_count из-за бага паджинации репостов: https://vk.com/wall-51742963_6860
     @fetch_all
     def fetch_repost_items(self, offset=0, count=1000, *args, **kwargs):
@@ -644,12 +1582,10 @@ class Post(WallAbstractModel):
         # owner_id
         # идентификатор пользователя или сообщества, на стене которого находится запись. Если параметр не задан, то он считается равным идентификатору текущего пользователя.
         # Обратите внимание, идентификатор сообщества в параметре owner_id необходимо указывать со знаком "-" — например, owner_id=-1 соответствует идентификатору сообщества ВКонтакте API (club1)
-        kwargs['owner_id'] = self.wall_owner.remote_id
-        if isinstance(self.wall_owner, Group):
-            kwargs['owner_id'] *= -1
+        kwargs['owner_id'] = self.remote_owner_id
         # post_id
         # идентификатор записи на стене.
-        kwargs['post_id'] = self.remote_id.split('_')[1]
+        kwargs['post_id'] = self.remote_id_short
         # offset
         # смещение, необходимое для выборки определенного подмножества записей.
         kwargs['offset'] = int(offset)
@@ -664,7 +1600,7 @@ class Post(WallAbstractModel):
         return response['items']
 
     @transaction.commit_on_success
-    def fetch_reposts_parser(self, offset=0):
+    def fetch_reposts_parser(self, offset=0, workers=None):
         '''
         OLD method via parser, may works incorrect
         Update and save fields:
@@ -672,32 +1608,6 @@ class Post(WallAbstractModel):
         Update relations
             * repost_users - users, who repost this post
         '''
-        post_data = {
-            'act': 'show',
-            'al': 1,
-            'w': 'shares/wall%s' % self.remote_id,
-        }
-
-        if offset == 0:
-            number_on_page = 40
-            post_data['loc'] = 'wall%s' % self.remote_id,
-        else:
-            number_on_page = 20
-            post_data['offset'] = offset
-
-        log.debug('Fetching reposts of post "%s" of owner "%s", offset %d' % (self.remote_id, self.wall_owner, offset))
-
-        parser = VkontakteWallParser().request('/wkview.php', data=post_data)
-        if offset == 0:
-            try:
-                self.reposts = int(parser.content_bs.find('a', {'id': 'wk_likes_tabshares'}).find('nobr').text.split()[0])
-                self.save()
-            except ValueError:
-                return
-            except:
-                log.warning('Strange markup of first page shares response: "%s"' % parser.content)
-            self.repost_users.clear()
-
         #<div id="post65120659_2341" class="post post_copy" onmouseover="wall.postOver('65120659_2341')" onmouseout="wall.postOut('65120659_2341')" data-copy="-16297716_126261" onclick="wall.postClick('65120659_2341', event)">
         #  <div class="post_table">
         #    <div class="post_image">
@@ -705,15 +1615,10 @@ class Post(WallAbstractModel):
         #    </div>
         #      <div class="wall_text"><a class="author" href="/vano0ooooo" data-from-id="65120659">Иван Панов</a> <div id="wpt65120659_2341"></div><table cellpadding="0" cellspacing="0" class="published_by_wrap">
 
-        items = parser.add_users(users=('div', {'id': re.compile('^post\d'), 'class': re.compile('^post ')}),
+        return self.fetch_users_parser('shares', 'repost_users', 'reposts', numbers_on_page=(40, 20), offset=offset, workers=workers,
+            users=('div', {'id': re.compile('^post\d'), 'class': re.compile('^post ')}),
             user_link=('a', {'class': 'author'}),
-            user_photo=lambda item: item.find('a', {'class': 'post_image'}).find('img'),
-            user_add=lambda user: self.repost_users.add(user))
-
-        if len(items) == number_on_page:
-            self.fetch_reposts(offset=offset + number_on_page)
-        else:
-            return self.repost_users.all()
+            user_photo=lambda item: item.find('a', {'class': 'post_image'}).find('img'))
 
     def fetch_statistic(self, *args, **kwargs):
         if 'vkontakte_wall_statistic' not in settings.INSTALLED_APPS:
@@ -726,6 +1631,8 @@ class Comment(WallAbstractModel):
     class Meta:
         verbose_name = u'Коментарий сообщения Вконтакте'
         verbose_name_plural = u'Комментарии сообщений Вконтакте'
+        # composite index (post, date) for timelines of posts is created by migration 0019
+        unique_together = ('owner_remote_id', 'item_remote_id')
 
     remote_pk_field = 'cid'
     likes_type = 'comment'
@@ -766,7 +1673,7 @@ class Comment(WallAbstractModel):
 
     like_users = ManyToManyHistoryField(User, related_name='like_comments')
 
-    objects = VkontakteCRUDManager()
+    objects = WallManager()
     remote = CommentRemoteManager(remote_pk=('remote_id',), methods={
         'get': 'getComments',
         'create': 'addComment',
@@ -776,8 +1683,23 @@ class Comment(WallAbstractModel):
     })
 
     def save(self, *args, **kwargs):
+        result = super(Comment, self).save(*args, **kwargs)
+
+        # replies of the same page, saved before this comment
+        replies = [reply for reply in getattr(self, '_page_replies', []) if reply.pk and not reply.reply_to_id]
+        if replies:
+            Comment.objects.filter(pk__in=[reply.pk for reply in replies]).update(reply_to=self.pk)
+            for reply in replies:
+                reply.reply_to_id = self.pk
+
+        return result
+
+    def prepare_save(self):
         self.wall_owner = self.post.wall_owner
-        return super(Comment, self).save(*args, **kwargs)
+        # comment replied to was saved after assigning
+        if not self.reply_to_id and self.reply_to:
+            self.reply_to_id = self.reply_to.pk
+        super(Comment, self).prepare_save()
 
     def prepare_create_params(self, **kwargs):
         kwargs.update({
@@ -811,25 +1733,96 @@ class Comment(WallAbstractModel):
         return None
 
     def parse(self, response):
-        self.raw_json = response
+        self.parse_raw_json(response)
         super(Comment, self).parse(response)
 
         if '_' not in str(self.remote_id):
-            self.remote_id = '%s_%s' % (self.post.remote_id.split('_')[0], self.remote_id)
+            self.remote_id = '%s_%s' % (self.post.remote_owner_id, self.remote_id)
+        self.parse_remote_id()
 
         for field_name in ['likes']:
             if field_name in response and 'count' in response[field_name]:
                 setattr(self, field_name, response.pop(field_name)['count'])
 
-        self.author = User.objects.get_or_create(remote_id=response['uid'])[0]
+        # authors, users and comments replied to are resolved for the whole page by CommentRemoteManager.parse_response_list
+        self.author = self.get_or_create_group_or_user(response['uid'])[0]
 
         if 'reply_to_uid' in response:
-            self.reply_for = User.objects.get_or_create(remote_id=response['reply_to_uid'])[0]
+            self.reply_for = self.get_or_create_group_or_user(response['reply_to_uid'])[0]
         if 'reply_to_cid' in response:
-            try:
-                self.reply_to = Comment.objects.get(remote_id=response['reply_to_cid'])
-            except:
-                pass
+            self._reply_to_remote_id = '%s_%s' % (self.post.remote_owner_id, response['reply_to_cid'])
+            if hasattr(self, '_reply_to_ids'):
+                self.reply_to_id = self._reply_to_ids.get(self._reply_to_remote_id)
+            else:
+                try:
+                    self.reply_to = Comment.objects.get(remote_id=self._reply_to_remote_id)
+                except Comment.DoesNotExist:
+                    pass
+
+
+class WallRawAbstractModel(models.Model):
+    '''
+    Raw payloads of post or comment, stored apart from the main table if VKONTAKTE_WALL_RAW_ARCHIVE is enabled
+    '''
+    class Meta:
+        abstract = True
+
+    raw_html = CompressedTextField()
+    raw_json = CompressedJSONField(default={}, null=True)
+
+
+class PostRaw(WallRawAbstractModel):
+    class Meta:
+        verbose_name = u'Исходные данные сообщения Вконтакте'
+        verbose_name_plural = u'Исходные данные сообщений Вконтакте'
+
+    instance = models.OneToOneField(Post, primary_key=True, related_name='raw')
+
+
+class CommentRaw(WallRawAbstractModel):
+    class Meta:
+        verbose_name = u'Исходные данные комментария Вконтакте'
+        verbose_name_plural = u'Исходные данные комментариев Вконтакте'
+
+    instance = models.OneToOneField(Comment, primary_key=True, related_name='raw')
+
+Post.raw_model = PostRaw
+Comment.raw_model = CommentRaw
+
+
+class WallSyncState(models.Model):
+    '''
+    State of the last incremental fetching of the wall, used by Post.remote.fetch_wall(incremental=True)
+    '''
+    class Meta:
+        verbose_name = u'Состояние синхронизации стены Вконтакте'
+        verbose_name_plural = u'Состояния синхронизации стен Вконтакте'
+        unique_together = ('owner_content_type', 'owner_id')
+
+    owner_content_type = models.ForeignKey(ContentType, related_name='vkontakte_wall_sync_states')
+    owner_id = models.PositiveIntegerField()
+    owner = generic.GenericForeignKey('owner_content_type', 'owner_id')
+
+    post_date = models.DateTimeField(u'Время последнего сообщения', null=True)
+    post_remote_id = models.PositiveIntegerField(u'ID последнего сообщения', null=True, help_text=u'Максимальный ID сообщения на стене')
+    synced = models.DateTimeField(u'Синхронизировано', null=True)
+
+    def __unicode__(self):
+        return u'%s: %s' % (self.owner, self.synced)
+
+    def update(self, posts):
+        '''
+        Move watermarks forward to the latest of fetched posts and save
+        '''
+        for date, remote_id in posts.values_list('date', 'item_remote_id'):
+            if not self.post_date or date > self.post_date:
+                self.post_date = date
+            if remote_id and (not self.post_remote_id or remote_id > self.post_remote_id):
+                self.post_remote_id = remote_id
+
+        self.synced = datetime.now()
+        self.save()
+
 
 Group.add_to_class('wall_posts', generic.GenericRelation(Post, content_type_field='wall_owner_content_type', object_id_field='wall_owner_id', related_name='group_wall', verbose_name=u'Сообщения на стене'))
 User.add_to_class('wall_posts', generic.GenericRelation(Post, content_type_field='wall_owner_content_type', object_id_field='wall_owner_id', related_name='user_wall', verbose_name=u'Сообщения на стене'))
@@ -1,73 +1,393 @@
 # -*- coding: utf-8 -*-
+from collections import OrderedDict
 from datetime import datetime
+from django.conf import settings
+from django.core.cache import get_cache
+from django.db import connection
 from django.dispatch.dispatcher import Signal
 from vkontakte_api.parser import VkontakteParser, VkontakteParseError
+import threading
+import time
 import re
 
+try:
+    from lxml import etree
+    import lxml.html
+except ImportError:
+    etree = None
+
 post_parsed = Signal(providing_args=['instance', 'raw_html'])
 comment_parsed = Signal(providing_args=['instance', 'raw_html'])
 
+# use lxml backend instead of BeautifulSoup, if it's enabled and installed.
+# Receivers of `parsed` signal get lxml elements instead of BeautifulSoup tags with it
+PARSER_LXML = getattr(settings, 'VKONTAKTE_WALL_PARSER_LXML', False) and etree is not None
+
+# selectors of elements of posts and comments: sequence of BeautifulSoup find() arguments and equivalent XPath
+SELECTORS = {
+    'date': ([('span', {'class': re.compile('^rel_date')})], 'descendant::span[starts-with(@class, "rel_date")]'),
+    'comment_text': ([('div', {'class': 'fw_reply_text'})], 'descendant::div[@class="fw_reply_text"]'),
+    'comment_likes': ([('span', {'class': 'like_count fl_l'})], 'descendant::span[@class="like_count fl_l"]'),
+    'comment_authors': ([('a', {'class': 'fw_reply_author'})], 'descendant::a[@class="fw_reply_author"]'),
+    'comment_avatar': ([('a', {'class': 'fw_reply_thumb'}), ('img',)], 'descendant::a[@class="fw_reply_thumb"][1]/descendant::img'),
+    'post_text': ([('div', {'class': 'wall_post_text'})], 'descendant::div[@class="wall_post_text"]'),
+    'post_likes': ([('span', {'class': 'post_like_count fl_l'})], 'descendant::span[@class="post_like_count fl_l"]'),
+    'post_show_comments': ([('div', {'class': 'wrh_text'})], 'descendant::div[@class="wrh_text"]'),
+    'post_replies': ([('div', {'class': 'reply_text'})], 'descendant::div[@class="reply_text"]'),
+    'post_author': ([('a', {'class': 'author'})], 'descendant::a[@class="author"]'),
+    'post_avatar': ([('a', {'class': 'post_image'}), ('img',)], 'descendant::a[@class="post_image"][1]/descendant::img'),
+    'post_published_by': ([('a', {'class': 'published_by'})], 'descendant::a[@class="published_by"]'),
+    'post_published_by_date': ([('a', {'class': 'published_by_date'})], 'descendant::a[@class="published_by_date"]'),
+    'post_copy_text': ([('div', {'class': 'published_comment wall_post_text'})], 'descendant::div[@class="published_comment wall_post_text"]'),
+    'comments': ([('div', {'class': 'fw_reply'})], 'descendant-or-self::div[@class="fw_reply"]'),
+}
+
+# selectors of likes by class names, used by VkontakteParser.parse_container_likes
+LIKES_SELECTORS = {'like_count fl_l': 'comment_likes', 'post_like_count fl_l': 'post_likes'}
+
+if etree is not None:
+    # compile XPath expressions once
+    XPATHS = dict([(name, etree.XPath(xpath)) for name, (steps, xpath) in SELECTORS.items()])
+    XPATH_POSTS = etree.XPath('descendant-or-self::div[starts-with(@class, "post") and starts-with(@id, $prefix)]')
+
+class SlugCache(object):
+    '''
+    Thread-safe LRU cache of resolved slugs with expiration, optionally backed by Django cache.
+    Values are tuples (content type id, remote id) or empty tuples for slugs, which can not be resolved
+    '''
+    def __init__(self, size=10000, timeout=86400, negative_timeout=3600, backend=None):
+        self.size = size
+        self.timeout = timeout
+        self.negative_timeout = negative_timeout
+        self.backend = get_cache(backend) if backend else None
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_key(self, slug):
+        return 'vkontakte_wall_slug_%s' % slug
+
+    def get(self, slug):
+        '''
+        Return cached value or None if slug is unknown
+        '''
+        with self.lock:
+            if slug in self.items:
+                value, expires = self.items.pop(slug)
+                if expires > time.time():
+                    # move to the end as recently used
+                    self.items[slug] = (value, expires)
+                    return value
+
+        if self.backend:
+            value = self.backend.get(self.get_key(slug))
+            if value is not None:
+                self.set(slug, tuple(value), backend=False)
+                return tuple(value)
+
+    def set(self, slug, value, backend=True):
+        timeout = self.timeout if value else self.negative_timeout
+        with self.lock:
+            self.items.pop(slug, None)
+            self.items[slug] = (value, time.time() + timeout)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+        if backend and self.backend:
+            self.backend.set(self.get_key(slug), value, timeout)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+slug_cache = SlugCache(size=getattr(settings, 'VKONTAKTE_WALL_SLUG_CACHE_SIZE', 10000),
+                       timeout=getattr(settings, 'VKONTAKTE_WALL_SLUG_CACHE_TIMEOUT', 86400),
+                       negative_timeout=getattr(settings, 'VKONTAKTE_WALL_SLUG_CACHE_NEGATIVE_TIMEOUT', 3600),
+                       backend=getattr(settings, 'VKONTAKTE_WALL_SLUG_CACHE_BACKEND', None))
+
+
+SLUG_ID_RE = re.compile(r'^(id|club|public|event)(\d+)$')
+
+
 def get_object_by_slug(slug):
+    return resolve_slugs([slug])[slug]
+
+
+def resolve_slugs(slugs):
+    '''
+    Return dict {slug: User or Group instance or None} using slug_cache.
+    Unknown slugs are resolved by resolveScreenName API calls, packed into `execute` requests.
+    Screen names stored in DB are not used for resolving, because they can be reassigned on the site
+    '''
+    from django.contrib.contenttypes.models import ContentType
     from vkontakte_users.models import User
     from vkontakte_groups.models import Group
-    instance = User.remote.get_by_slug(slug)
-    if not instance:
-        instance = Group.remote.get_by_slug(slug)
-    return instance
+    from utils import execute_api_calls
+
+    slugs = set([slug for slug in slugs if slug])
+    resolved = {}
+    unknown = []
+    for slug in slugs:
+        value = slug_cache.get(slug)
+        match = SLUG_ID_RE.match(slug)
+        if value is not None:
+            resolved[slug] = value
+        elif match:
+            # slugs like id1 or club1 contain remote id
+            model = User if match.group(1) == 'id' else Group
+            resolved[slug] = (ContentType.objects.get_for_model(model).pk, int(match.group(2)))
+        else:
+            unknown += [slug]
+
+    if unknown:
+        models = {'user': User, 'group': Group, 'page': Group, 'event': Group}
+        responses = execute_api_calls([('utils.resolveScreenName', {'screen_name': slug}) for slug in unknown])
+        for slug, response in zip(unknown, responses):
+            if response is None:
+                # error of request, resolving by slug in the old way
+                instance = User.remote.get_by_slug(slug) or Group.remote.get_by_slug(slug)
+                resolved[slug] = (ContentType.objects.get_for_model(instance).pk, instance.remote_id) if instance else ()
+            elif isinstance(response, dict) and response.get('type') in models:
+                resolved[slug] = (ContentType.objects.get_for_model(models[response['type']]).pk, int(response['object_id']))
+            else:
+                resolved[slug] = ()
+            slug_cache.set(slug, resolved[slug])
+
+    # instances with one query per model
+    instances = dict([(slug, None) for slug in slugs])
+    for model in [User, Group]:
+        ct_id = ContentType.objects.get_for_model(model).pk
+        remote_ids = [(slug, value[1]) for slug, value in resolved.items() if value and value[0] == ct_id]
+        if not remote_ids:
+            continue
+        existing = dict([(instance.remote_id, instance) for instance in model.objects.filter(remote_id__in=set([remote_id for slug, remote_id in remote_ids]))])
+        for slug, remote_id in remote_ids:
+            # screen name of existing instance is changed by VkontakteWallParser.update_user to be detected and saved
+            instances[slug] = existing.get(remote_id) or model(remote_id=remote_id, screen_name=slug)
+
+    return instances
 
 class VkontakteWallParser(VkontakteParser):
 
+    def __init__(self, content='', lxml=None, defer_users_saving=False):
+        super(VkontakteWallParser, self).__init__(content)
+        self.lxml = PARSER_LXML if lxml is None else lxml and etree is not None
+        # save changed users by save_users once per page
+        self.defer_users_saving = defer_users_saving
+        self.users_changed = {}
+
+    @property
+    def content_lxml(self):
+        html = self.html
+        return lxml.html.fromstring(html) if html.strip() else None
+
+    def is_lxml(self, node):
+        return etree is not None and isinstance(node, etree._Element)
+
+    def find(self, node, name):
+        '''
+        Return the first element by name of selector or None
+        '''
+        steps, xpath = SELECTORS[name]
+        if self.is_lxml(node):
+            result = XPATHS[name](node)
+            return result[0] if result else None
+        for args in steps:
+            node = node.find(*args)
+            if node is None:
+                return None
+        return node
+
+    def find_all(self, node, name):
+        '''
+        Return list of elements by name of selector with only one step
+        '''
+        steps, xpath = SELECTORS[name]
+        if self.is_lxml(node):
+            return XPATHS[name](node)
+        return node.findAll(*steps[0])
+
+    def get_text(self, node):
+        '''
+        Return text of element, joined from stripped strings the same way as BeautifulSoup does
+        '''
+        return u''.join([text.strip() for text in node.itertext()]) if self.is_lxml(node) else node.text
+
+    def to_html(self, node):
+        return etree.tostring(node, encoding=unicode, method='html', with_tail=False) if self.is_lxml(node) else unicode(node)
+
+    def get_posts(self, owner_remote_id):
+        '''
+        Return list of containers of posts of the wall page
+        '''
+        if self.lxml:
+            content = self.content_lxml
+            return XPATH_POSTS(content, prefix='post-%d' % owner_remote_id) if content is not None else []
+        return self.content_bs.findAll('div', {'class': re.compile('^post'), 'id': re.compile('^post-%d' % owner_remote_id)})
+
+    def get_comments(self):
+        '''
+        Return list of containers of comments of the post page
+        '''
+        if self.lxml:
+            content = self.content_lxml
+            return self.find_all(content, 'comments') if content is not None else []
+        return self.find_all(self.content_bs, 'comments')
+
+    def resolve_slugs(self, items):
+        '''
+        Resolve slugs of authors of all posts or comments of the page at once before parsing them
+        '''
+        slugs = []
+        for item in items:
+            for name in ['comment_authors', 'post_author', 'post_published_by']:
+                slugs += [(link.get('href') or '')[1:] for link in self.find_all(item, name)]
+        self.objects_by_slug = resolve_slugs(slugs)
+
+    def get_object_by_slug(self, slug):
+        objects = getattr(self, 'objects_by_slug', {})
+        return objects[slug] if slug in objects else get_object_by_slug(slug)
+
+    def update_user(self, user, name_parts, avatar, slug=None):
+        '''
+        Set name, photo and screen name of author, parsed from the page, and save it only if something changed
+        '''
+        values = {'first_name': name_parts[0], 'photo': avatar}
+        if slug:
+            values['screen_name'] = slug
+        if len(name_parts) > 1:
+            values['last_name'] = name_parts[1]
+        field_names = user._meta.get_all_field_names()
+        values = dict([(key, value) for key, value in values.items() if key in field_names])
+        changed = [key for key, value in values.items() if getattr(user, key) != value]
+        for key, value in values.items():
+            setattr(user, key, value)
+
+        if user._state.adding:
+            user.save()
+        elif changed:
+            if self.defer_users_saving:
+                self.users_changed[(user.__class__, user.pk)] = user
+            else:
+                user.save()
+
+    def save_users(self, chunk_size=100):
+        '''
+        Save names, photos and screen names of changed users of the page with one UPDATE query per model
+        '''
+        users_by_model = {}
+        for (model, pk), user in self.users_changed.items():
+            users_by_model.setdefault(model, []).append(user)
+        self.users_changed = {}
+
+        qn = connection.ops.quote_name
+        for model, users in users_by_model.items():
+            fields = [field for field in model._meta.local_fields if field.name in ['first_name', 'last_name', 'photo', 'screen_name']]
+            pk_column = qn(model._meta.pk.column)
+            for i in range(0, len(users), chunk_size):
+                chunk = users[i:i + chunk_size]
+                sql = 'UPDATE %s SET %s WHERE %s IN (%s)' % (qn(model._meta.db_table),
+                    ', '.join(['%s = CASE %s %s END' % (qn(field.column), pk_column, ' '.join(['WHEN %s THEN %s'] * len(chunk))) for field in fields]),
+                    pk_column, ', '.join(['%s'] * len(chunk)))
+                params = []
+                for field in fields:
+                    for user in chunk:
+                        params += [user.pk, field.get_db_prep_save(getattr(user, field.attname), connection=connection)]
+                params += [user.pk for user in chunk]
+                connection.cursor().execute(sql, params)
+
+    def get_remote_id(self, content):
+        return content.get('id')[4:]
+
+    def get_instances(self, model, items):
+        '''
+        Return dict of existing posts or comments of the page and posts, copied by them, by remote ids with one query.
+        Instances are selected with all fields for comparing them with parsed values
+        '''
+        remote_ids = [self.get_remote_id(item) for item in items]
+        for item in items:
+            post_link = self.find(item, 'post_published_by_date')
+            if post_link is not None and post_link.get('href'):
+                remote_ids += [post_link.get('href')[5:]]
+        return dict([(instance.remote_id, instance) for instance in model.objects.full().filter(remote_id__in=remote_ids)])
+
     def parse_container_date(self, container):
 
-        text = container.find('span', {'class': re.compile('^rel_date')})
-        if text:
-            return self.parse_date(text.text)
+        text = self.find(container, 'date')
+        if text is not None:
+            return self.parse_date(self.get_text(text))
         else:
-            raise VkontakteParseError("Impossible to find date container in %s" % container)
+            raise VkontakteParseError("Impossible to find date container in %s" % self.to_html(container))
 
-    def parse_comment(self, content, wall_owner=None):
-        from models import Comment
+    def parse_container_likes(self, container, classname):
+        '''
+        Compatible with VkontakteParser.parse_container_likes: likes are found by class name of span element
+        '''
+        name = LIKES_SELECTORS.get(classname)
+        if name:
+            return self.parse_likes(container, name)
+        if self.is_lxml(container):
+            try:
+                value = self.get_text(container.xpath('descendant::span[@class=$classname]', classname=classname)[0])
+                return value and int(value) or 0
+            except Exception, e:
+                raise VkontakteParseError("Error while parsing post likes value: %s" % e)
+        return super(VkontakteWallParser, self).parse_container_likes(container, classname)
 
-        remote_id = content['id'][4:]
+    def parse_likes(self, container, name):
+        '''
+        Return amount of likes from element by name of selector
+        '''
         try:
-            instance = Comment.objects.get(remote_id=remote_id)
-        except Comment.DoesNotExist:
-            instance = Comment(remote_id=remote_id)
+            value = self.get_text(self.find(container, name))
+            return value and int(value) or 0
+        except Exception, e:
+            raise VkontakteParseError("Error while parsing post likes value: %s" % e)
 
-        comment_text = content.find('div', {'class': 'fw_reply_text'})
-        if comment_text:
-            instance.text = comment_text.text
+    def parse_comment(self, content, wall_owner=None, instances=None):
+        '''
+        Argument `instances` is a dict of existing comments of the page by remote ids, returned by get_instances
+        '''
+        from models import Comment
+
+        remote_id = self.get_remote_id(content)
+        if instances is not None:
+            instance = instances.get(remote_id) or Comment(remote_id=remote_id)
+        else:
+            try:
+                instance = Comment.objects.full().get(remote_id=remote_id)
+            except Comment.DoesNotExist:
+                instance = Comment(remote_id=remote_id)
+
+        comment_text = self.find(content, 'comment_text')
+        if comment_text is not None:
+            instance.text = self.get_text(comment_text)
 
         # date
         instance.date = self.parse_container_date(content)
         # likes
-        instance.likes = self.parse_container_likes(content, 'like_count fl_l')
+        instance.likes = self.parse_likes(content, 'comment_likes')
 
         # author
-        users = content.findAll('a', {'class': 'fw_reply_author'})
-        slug = users[0]['href'][1:]
+        users = self.find_all(content, 'comment_authors')
+        slug = users[0].get('href')[1:]
         if wall_owner and wall_owner.screen_name == slug:
             instance.author = wall_owner
         else:
-            avatar = content.find('a', {'class': 'fw_reply_thumb'}).find('img')['src']
-            name_parts = users[0].text.split(' ')
+            avatar = self.find(content, 'comment_avatar').get('src')
+            name_parts = self.get_text(users[0]).split(' ')
 
-            user = get_object_by_slug(slug)
+            user = self.get_object_by_slug(slug)
             if user:
-                user.first_name = name_parts[0]
-                if len(name_parts) > 1:
-                    user.last_name = name_parts[1]
-                user.photo = avatar
-                user.save()
+                self.update_user(user, name_parts, avatar, slug)
                 instance.author = user
 
         if len(users) == 2:
             # this comment is answer
-            slug = users[1]['href'][1:]
+            slug = users[1].get('href')[1:]
             if wall_owner and wall_owner.screen_name == slug:
                 instance.reply_for = wall_owner
             else:
-                instance.reply_for = get_object_by_slug(slug)
+                instance.reply_for = self.get_object_by_slug(slug)
                 # имя в падеже, аватара нет
                 # чтобы получть текст и ID родительского коммента нужно отправить:
                 #http://vk.com/al_wall.php
@@ -78,32 +398,38 @@ class VkontakteWallParser(VkontakteParser):
 
         instance.fetched = datetime.now()
 
-        comment_parsed.send(sender=Comment, instance=instance, raw_html=str(content))
+        comment_parsed.send(sender=Comment, instance=instance, raw_html=self.to_html(content).encode('utf-8'))
         return instance
 
-    def parse_post(self, content, wall_owner):
+    def parse_post(self, content, wall_owner, instances=None):
+        '''
+        Argument `instances` is a dict of existing posts and copied posts of the page by remote ids, returned by get_instances
+        '''
         from models import Post
         from vkontakte_users.models import User
 
-        remote_id = content['id'][4:]
-        try:
-            instance = Post.objects.get(remote_id=remote_id)
-        except Post.DoesNotExist:
-            instance = Post(remote_id=remote_id)
+        remote_id = self.get_remote_id(content)
+        if instances is not None:
+            instance = instances.get(remote_id) or Post(remote_id=remote_id)
+        else:
+            try:
+                instance = Post.objects.full().get(remote_id=remote_id)
+            except Post.DoesNotExist:
+                instance = Post(remote_id=remote_id)
 
-        post_text = content.find('div', {'class': 'wall_post_text'})
-        if post_text:
-            instance.text = post_text.text
+        post_text = self.find(content, 'post_text')
+        if post_text is not None:
+            instance.text = self.get_text(post_text)
 
         # date
         instance.date = self.parse_container_date(content)
         # likes
-        instance.likes = self.parse_container_likes(content, 'post_like_count fl_l')
+        instance.likes = self.parse_likes(content, 'post_likes')
 
         # comments
-        show_comments = content.find('div', {'class': 'wrh_text'})
-        if show_comments:
-            comments_words = show_comments.text.split(' ')
+        show_comments = self.find(content, 'post_show_comments')
+        if show_comments is not None:
+            comments_words = self.get_text(show_comments).split(' ')
             if len(comments_words) in [3,4]:
                 # Показать все 95 комментариев
                 # Показать 91 комментарий
@@ -112,27 +438,23 @@ class VkontakteWallParser(VkontakteParser):
                 # Показать последние 100 комментариев из 170
                 instance.comments = int(comments_words[-1])
             else:
-                raise VkontakteParseError("Error number of words in show all comments message: '%s'" % show_comments.text.encode('utf-8'))
+                raise VkontakteParseError("Error number of words in show all comments message: '%s'" % self.get_text(show_comments).encode('utf-8'))
         else:
-            instance.comments = len(content.findAll('div', {'class': 'reply_text'}))
+            instance.comments = len(self.find_all(content, 'post_replies'))
 
         # author
-        owner_slug = content.find('a', {'class': 'author'})['href'][1:]
+        owner_slug = self.find(content, 'post_author').get('href')[1:]
         if wall_owner and wall_owner.screen_name == owner_slug:
             instance.author = wall_owner
         else:
             # author is someone else,
             # possible user, becouse the group can post only on it's own wall, where wall_owner is defined
-            avatar = content.find('a', {'class': 'post_image'}).find('img')['src']
-            name_parts = content.find('a', {'class': 'author'}).text.split(' ')
+            avatar = self.find(content, 'post_avatar').get('src')
+            name_parts = self.get_text(self.find(content, 'post_author')).split(' ')
 
-            user = get_object_by_slug(owner_slug)
+            user = self.get_object_by_slug(owner_slug)
             if user:
-                user.first_name = name_parts[0]
-                if len(name_parts) > 1:
-                    user.last_name = name_parts[1]
-                user.photo = avatar
-                user.save()
+                self.update_user(user, name_parts, avatar, owner_slug)
                 instance.author = user
 
         instance.fetched = datetime.now()
@@ -144,19 +466,25 @@ class VkontakteWallParser(VkontakteParser):
         #  <div class="published_by_date"><a class="published_by_date"  href="/wall59124156_8301" onclick="return showWiki({w: 'wall59124156_8301'}, false, event);" >29 янв 2013 в 15:51</a></div>
         #</td>
         try:
-            slug = content.find('a', {'class': 'published_by'})['href'][1:]
-            post_link = content.find('a', {'class': 'published_by_date'})
-            instance.copy_owner = get_object_by_slug(slug)
-            instance.copy_post = Post.objects.get_or_create(remote_id=content.find('a', {'class': 'published_by_date'})['href'][5:], defaults={
-                'wall_owner': instance.copy_owner,
-                'date': self.parse_date(post_link.text)
-            })[0]
+            slug = self.find(content, 'post_published_by').get('href')[1:]
+            post_link = self.find(content, 'post_published_by_date')
+            instance.copy_owner = self.get_object_by_slug(slug)
+            copy_remote_id = post_link.get('href')[5:]
+            if instances is not None and copy_remote_id in instances:
+                instance.copy_post = instances[copy_remote_id]
+            else:
+                instance.copy_post = Post.objects.get_or_create(remote_id=copy_remote_id, defaults={
+                    'wall_owner': instance.copy_owner,
+                    'date': self.parse_date(self.get_text(post_link))
+                })[0]
+                if instances is not None:
+                    instances[copy_remote_id] = instance.copy_post
         except:
             pass
         # <div class="published_comment wall_post_text">дядька молодец</div>
-        copy_text = content.find('div', {'class': 'published_comment wall_post_text'})
-        if copy_text:
-            instance.copy_text = copy_text.text
+        copy_text = self.find(content, 'post_copy_text')
+        if copy_text is not None:
+            instance.copy_text = self.get_text(copy_text)
 
-        post_parsed.send(sender=Post, instance=instance, raw_html=str(content))
+        post_parsed.send(sender=Post, instance=instance, raw_html=self.to_html(content).encode('utf-8'))
         return instance
\ No newline at end of file
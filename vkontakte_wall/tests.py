@@ -1,14 +1,19 @@
 # -*- coding: utf-8 -*-
 from django.test import TestCase
-from models import Post, Comment
+from django.db import connection
+from django.db.models.signals import m2m_changed
+from models import Post, Comment, WallSyncState
+from parser import VkontakteWallParser, resolve_slugs, slug_cache
 from factories import PostFactory, UserFactory, GroupFactory, CommentFactory
 from vkontakte_users.factories import User
+from vkontakte_groups.models import Group
 from vkontakte_users.tests import user_fetch_mock
 from datetime import datetime
 from mock import MagicMock
 import simplejson as json
 import mock
 import time
+import re
 
 USER_ID = 5223304
 POST_ID = '5223304_130'
@@ -248,6 +253,29 @@ class VkontakteWallTest(TestCase):
         self.assertTrue(post.likes > 120)
         self.assertEqual(post.likes, post.like_users.count())
 
+    def test_fetch_post_likes_parser_pages(self):
+
+        group = GroupFactory(remote_id=GROUP_ID)
+        post = PostFactory(remote_id=GROUP_POST_ID, wall_owner=group)
+        User.objects.bulk_create([User(remote_id=i) for i in range(1, 251)])
+        users = list(User.objects.filter(remote_id__lte=250).order_by('remote_id'))
+
+        def request(url, data):
+            offset = data.get('offset', 0)
+            parser = MagicMock()
+            parser.content_bs.find.return_value.find.return_value.text = u'250 человек'
+            page_users = users[offset:offset + (120 if offset == 0 else 60)]
+            parser.add_users.side_effect = lambda user_add, **kw: [user_add(user) for user in page_users]
+            return parser
+
+        for workers in [None, 2]:
+            with mock.patch('vkontakte_wall.models.VkontakteWallParser.request', side_effect=request) as parser_request:
+                post.fetch_likes(source='parser', workers=workers)
+
+            self.assertItemsEqual([call[1]['data'].get('offset', 0) for call in parser_request.call_args_list], [0, 120, 180, 240])
+            self.assertEqual(post.likes, 250)
+            self.assertEqual(post.like_users.count(), 250)
+
     @mock.patch('vkontakte_users.models.User.remote.fetch', side_effect=user_fetch_mock)
     def test_fetch_group_post_likes(self, *args, **kwargs):
 
@@ -309,6 +337,31 @@ class VkontakteWallTest(TestCase):
         self.assertEqual(post.reposts, User.objects.count() - users_initial)
         self.assertEqual(post.reposts, post.repost_users.count())
 
+    def test_update_like_users_history(self):
+        post = PostFactory(wall_owner=GroupFactory(remote_id=GROUP_ID))
+        users = [UserFactory(remote_id=i) for i in range(1, 5)]
+        through = post.like_users.through
+        signals = []
+        receiver = lambda sender, action, pk_set, **kw: signals.append((action, set(pk_set)))
+        m2m_changed.connect(receiver, sender=through)
+        try:
+            post.update_like_users(set([user.pk for user in users[:3]]))
+            post.update_like_users(set([user.pk for user in users[:1]]))
+            post.update_like_users(set([user.pk for user in users]))
+        finally:
+            m2m_changed.disconnect(receiver, sender=through)
+
+        self.assertItemsEqual(post.like_users.all(), users)
+        self.assertEqual(through.objects.filter(post=post).count(), 6)
+        self.assertEqual(through.objects.filter(post=post, time_to=None).count(), 4)
+        for user in users[1:3]:
+            removed, added = through.objects.filter(post=post, user=user).order_by('time_from')
+            self.assertTrue(removed.time_from <= removed.time_to <= added.time_from)
+            self.assertEqual(added.time_to, None)
+        self.assertEqual(through.objects.get(post=post, user=users[0]).time_to, None)
+        self.assertEqual([action for action, pk_set in signals], ['pre_add', 'post_add', 'pre_remove', 'post_remove', 'pre_add', 'post_add'])
+        self.assertEqual(signals[3][1], set([user.pk for user in users[1:3]]))
+
     @mock.patch('vkontakte_users.models.User.remote.fetch', side_effect=user_fetch_mock)
     def test_fetch_group_post_changing_likes(self, *args, **kwargs):
 
@@ -372,6 +425,61 @@ class VkontakteWallTest(TestCase):
         self.assertEqual(instance.post_id, post.pk)
         self.assertEqual(instance.time_from, datetime.fromtimestamp(resources[0]['date']))
 
+    @mock.patch('vkontakte_users.models.User.remote.fetch', side_effect=user_fetch_mock)
+    def test_fetch_group_post_reposts_posts(self, *args, **kwargs):
+
+        group = GroupFactory(remote_id=GROUP_ID)
+        post = PostFactory(remote_id=GROUP_POST_ID, wall_owner=group)
+
+        resources = [{'id': 10, 'from_id': 1, 'to_id': 1, 'date': int(time.time()), 'text': 'repost',
+                      'copy_owner_id': -GROUP_ID, 'copy_post_id': post.remote_id_short},
+                     {'id': 20, 'from_id': -GROUP2_ID, 'to_id': -GROUP2_ID, 'date': int(time.time()), 'text': '',
+                      'copy_owner_id': -GROUP_ID, 'copy_post_id': post.remote_id_short}]
+        with mock.patch('vkontakte_wall.models.Post.fetch_repost_items', side_effect=lambda **kw: resources):
+            post.fetch_reposts(all=True, store_posts=True)
+
+        self.assertEqual(post.reposts, 1)
+        self.assertItemsEqual(post.wall_reposts.values_list('remote_id', flat=True), ['1_10', '-%s_20' % GROUP2_ID])
+        self.assertItemsEqual([repost.copy_owner for repost in post.wall_reposts.all()], [group, group])
+
+    @mock.patch('vkontakte_users.models.User.remote.fetch', side_effect=user_fetch_mock)
+    def test_fetch_group_post_reposts_staging(self, *args, **kwargs):
+
+        group = GroupFactory(remote_id=GROUP_ID)
+        post = PostFactory(remote_id=GROUP_POST_ID, wall_owner=group)
+        post.repost_users.through.objects.bulk_create([post.repost_users.through(user_id=1, post_id=post.pk)])
+
+        pages = {0: [{'from_id': 1, 'date': int(time.time())}, {'from_id': 2, 'date': int(time.time())}],
+                 2: [{'from_id': 3, 'date': int(time.time())}, {'from_id': -GROUP_ID, 'date': int(time.time())}]}
+        with mock.patch('vkontakte_wall.models.Post.fetch_repost_items', side_effect=lambda offset, **kw: pages.get(offset, [])) as fetch:
+            post.fetch_reposts(all=True, staging=True)
+
+        self.assertEqual(fetch.call_count, 6)
+        self.assertEqual(post.reposts, 3)
+        self.assertItemsEqual(post.repost_users.get_query_set(only_pk=True), [1, 2, 3])
+        self.assertEqual(post.repost_users.through.objects.filter(time_from=None).count(), 0)
+
+        # the same reposts again
+        with mock.patch('vkontakte_wall.models.Post.fetch_repost_items', side_effect=lambda offset, **kw: pages.get(offset, [])):
+            post.fetch_reposts(all=True, staging=True)
+
+        self.assertEqual(post.repost_users.through.objects.count(), 3)
+
+        # user 2 removed repost
+        pages = {0: pages[0][:1], 1: pages[2]}
+        with mock.patch('vkontakte_wall.models.Post.fetch_repost_items', side_effect=lambda offset, **kw: pages.get(offset, [])):
+            post.fetch_reposts(all=True, staging=True)
+
+        self.assertItemsEqual(post.repost_users.get_query_set(only_pk=True), [1, 3])
+        self.assertEqual(post.repost_users.through.objects.get(user_id=2).time_to is None, False)
+
+        # the original error is raised and the temporary table is dropped
+        with mock.patch('vkontakte_wall.models.Post.fetch_repost_items', side_effect=ValueError('error')):
+            self.assertRaises(ValueError, post.fetch_reposts, all=True, staging=True)
+        with mock.patch('vkontakte_wall.models.Post.fetch_repost_items', side_effect=lambda offset, **kw: pages.get(offset, [])):
+            post.fetch_reposts(all=True, staging=True)
+        self.assertItemsEqual(post.repost_users.get_query_set(only_pk=True), [1, 3])
+
     @mock.patch('vkontakte_users.models.User.remote.fetch', side_effect=user_fetch_mock)
     def test_fetch_group_post_changing_reposts(self, *args, **kwargs):
 
@@ -472,6 +580,483 @@ class VkontakteWallTest(TestCase):
         self.assertEqual(instance.text, 'qwerty')
         self.assertTrue(isinstance(instance.date, datetime))
 
+    def test_fetch_wall_bulk(self):
+        owner = UserFactory(remote_id=USER_ID)
+        response = [3] + [{'id': i, 'to_id': USER_ID, 'from_id': USER_ID, 'date': 1298365200 + i, 'text': 'post %d' % i,
+                           'likes': {'count': i}} for i in range(1, 4)]
+
+        with mock.patch('vkontakte_wall.models.Post.remote.api_call', side_effect=lambda *a, **kw: response):
+            posts = Post.remote.fetch_wall(owner=owner, bulk=True)
+
+        self.assertEqual(posts.count(), Post.objects.count(), 3)
+        self.assertItemsEqual(posts.values_list('remote_id', flat=True), ['%s_%d' % (USER_ID, i) for i in range(1, 4)])
+        self.assertEqual(Post.objects.get(remote_id='%s_2' % USER_ID).wall_owner, owner)
+
+        pks = dict(Post.objects.values_list('remote_id', 'pk'))
+        response[1]['likes']['count'] = 100
+        response += [{'id': 4, 'to_id': USER_ID, 'from_id': USER_ID, 'date': 1298365204, 'text': 'post 4'}]
+
+        with mock.patch('vkontakte_wall.models.Post.remote.api_call', side_effect=lambda *a, **kw: response):
+            posts = Post.remote.fetch_wall(owner=owner, bulk=True)
+
+        self.assertEqual(posts.count(), Post.objects.count(), 4)
+        self.assertEqual(Post.objects.get(remote_id='%s_1' % USER_ID).likes, 100)
+        self.assertEqual(Post.objects.get(remote_id='%s_1' % USER_ID).pk, pks['%s_1' % USER_ID])
+
+    def test_bulk_update_changed_columns(self):
+        owner = UserFactory(remote_id=USER_ID)
+        posts = [PostFactory(wall_owner=owner, author=owner, likes=1, text='post') for i in range(3)]
+        posts = list(Post.objects.full().filter(pk__in=[post.pk for post in posts]).order_by('pk'))
+        posts[0].likes = 10
+        posts[1].text = 'changed'
+
+        with self.assertNumQueries(2):
+            Post.remote.bulk_update(posts)
+
+        # queries captured by assertNumQueries are left in connection.queries
+        update = connection.queries[-1]['sql']
+        self.assertTrue('"likes" = CASE' in update and '"text" = CASE' in update)
+        self.assertFalse('"date"' in update)
+        self.assertEqual([(post.likes, post.text) for post in Post.objects.order_by('pk')], [(10, 'post'), (1, 'changed'), (1, 'post')])
+
+    def test_fetch_wall_incremental(self):
+        owner = UserFactory(remote_id=USER_ID)
+        post = lambda i: {'id': i, 'to_id': USER_ID, 'from_id': USER_ID, 'date': 1298365200 + i, 'text': 'post %d' % i}
+
+        response = [3, post(3), post(2), post(1)]
+        with mock.patch('vkontakte_wall.models.Post.remote.api_call', side_effect=lambda *a, **kw: response):
+            posts = Post.remote.fetch_wall(owner=owner, incremental=True)
+
+        state = WallSyncState.objects.get(owner_id=owner.pk)
+        self.assertEqual(posts.count(), 3)
+        self.assertEqual(state.post_remote_id, 3)
+        self.assertEqual(state.post_date, datetime.fromtimestamp(1298365203))
+
+        response = [5, post(5), post(4), post(3), post(2), post(1)]
+        with mock.patch('vkontakte_wall.models.Post.remote.api_call', side_effect=lambda *a, **kw: response):
+            posts = Post.remote.fetch_wall(owner=owner, incremental=True)
+
+        state = WallSyncState.objects.get(owner_id=owner.pk)
+        # paging stops on the last known post
+        self.assertItemsEqual(posts.values_list('remote_id', flat=True), ['%s_%d' % (USER_ID, i) for i in [5, 4]])
+        self.assertEqual(Post.objects.count(), 5)
+        self.assertEqual(state.post_remote_id, 5)
+
+    def test_fetch_wall_incremental_with_pinned_post(self):
+        owner = UserFactory(remote_id=USER_ID)
+        post = lambda i: {'id': i, 'to_id': USER_ID, 'from_id': USER_ID, 'date': 1298365200 + i, 'text': 'post %d' % i}
+        pinned = dict(post(1), is_pinned=1)
+        WallSyncState.objects.create(owner=owner, post_remote_id=3, post_date=datetime.fromtimestamp(1298365203))
+
+        # old pinned post on the top of the first page, then new posts and known one, which date is later after editing
+        pages = [[7, pinned, post(7), post(6)], [7, post(5), post(4), dict(post(3), date=1298365300)]]
+        with mock.patch('vkontakte_wall.models.Post.remote.api_call', side_effect=lambda *a, **kw: pages[min(kw['offset'] / 3, 1)]):
+            posts = Post.remote.fetch_wall(owner=owner, incremental=True, count=3)
+
+        self.assertItemsEqual(posts.values_list('item_remote_id', flat=True), [1, 7, 6, 5, 4])
+        self.assertEqual(WallSyncState.objects.get(owner_id=owner.pk).post_remote_id, 7)
+
+    def test_iter_wall(self):
+        owner = UserFactory(remote_id=USER_ID)
+        posts = [{'id': i, 'to_id': USER_ID, 'from_id': USER_ID, 'date': 1298365200 - i, 'text': 'post %d' % i} for i in range(5)]
+
+        with mock.patch('vkontakte_wall.models.Post.remote.api_call', side_effect=lambda *a, **kw: [5] + posts[kw['offset']:kw['offset'] + kw['count']]) as api_call:
+            iterator = Post.remote.iter_wall(owner=owner, count=2)
+            self.assertEqual(api_call.call_count, 0)
+
+            first = iterator.next()
+            self.assertEqual(api_call.call_count, 1)
+            self.assertEqual(Post.objects.count(), 2)
+
+            self.assertEqual(len([first] + list(iterator)), 5)
+            self.assertEqual(api_call.call_count, 3)
+            self.assertEqual(Post.objects.count(), 5)
+
+    def test_fetch_wall_parallel(self):
+        owner = UserFactory(remote_id=USER_ID)
+        posts = [{'id': i, 'to_id': USER_ID, 'from_id': USER_ID, 'date': 1298365200 - i, 'text': 'post %d' % i} for i in range(5)]
+
+        with mock.patch('vkontakte_wall.models.Post.remote.api_call', side_effect=lambda *a, **kw: [5] + posts[kw['offset']:kw['offset'] + kw['count']]) as api_call:
+            instances = Post.remote.fetch_wall(owner=owner, count=2, all=True, workers=2)
+
+        self.assertEqual(api_call.call_count, 3)
+        self.assertItemsEqual([call[1]['offset'] for call in api_call.call_args_list], [0, 2, 4])
+        self.assertEqual(instances.count(), Post.objects.count(), 5)
+
+    def test_fetch_wall_parallel_stops_after(self):
+        owner = UserFactory(remote_id=USER_ID)
+        posts = [{'id': i, 'to_id': USER_ID, 'from_id': USER_ID, 'date': 1298365200 - i * 100, 'text': 'post %d' % i} for i in range(20)]
+        after = Post.remote.parse_response_list([posts[2]])[0].date
+
+        with mock.patch('vkontakte_wall.models.Post.remote.api_call', side_effect=lambda *a, **kw: [20] + posts[kw['offset']:kw['offset'] + kw['count']]) as api_call:
+            instances = Post.remote.fetch_wall(owner=owner, count=2, all=True, workers=2, after=after)
+
+        # the first page and one window of 2 pages, the last one is out of timeline
+        self.assertItemsEqual([call[1]['offset'] for call in api_call.call_args_list], [0, 2, 4])
+        self.assertEqual(instances.count(), Post.objects.count(), 3)
+
+    def test_rate_limiter(self):
+        from utils import RateLimiter, rate_limiter
+        self.assertEqual(rate_limiter.rate, None)
+
+        with mock.patch('time.sleep') as sleep:
+            RateLimiter(None).acquire()
+            self.assertEqual(sleep.call_count, 0)
+
+            limiter = RateLimiter(2)
+            for i in range(3):
+                limiter.acquire()
+            self.assertEqual(sleep.call_count, 1)
+
+    def test_fetch_wall_skips_unchanged_posts(self):
+        owner = UserFactory(remote_id=USER_ID)
+        response = [2] + [{'id': i, 'to_id': USER_ID, 'from_id': USER_ID, 'date': 1298365200 + i, 'text': 'post', 'likes': {'count': 1}} for i in [1, 2]]
+
+        with mock.patch('vkontakte_wall.models.Post.remote.api_call', side_effect=lambda *a, **kw: response):
+            Post.remote.fetch_wall(owner=owner)
+            self.assertEqual(Post.objects.exclude(raw_json_hash='').count(), 2)
+
+            with mock.patch('vkontakte_wall.models.Post.save') as save:
+                posts = Post.remote.fetch_wall(owner=owner)
+                self.assertEqual(save.call_count, 0)
+                self.assertEqual(posts.count(), 2)
+
+            response[1]['likes']['count'] = 5
+            Post.remote.fetch_wall(owner=owner)
+            self.assertEqual(Post.objects.get(remote_id='%s_1' % USER_ID).likes, 5)
+
+    def test_fetch_wall_updates_only_changed_fields(self):
+        owner = UserFactory(remote_id=USER_ID)
+        response = [1, {'id': 1, 'to_id': USER_ID, 'from_id': USER_ID, 'date': 1298365200, 'text': 'post', 'likes': {'count': 1},
+                        'attachments': [{'type': 'photo'}], 'geo': {'type': 'place'}}]
+
+        with mock.patch('vkontakte_wall.models.Post.remote.api_call', side_effect=lambda *a, **kw: response):
+            Post.remote.fetch_wall(owner=owner)
+
+            response[1]['likes']['count'] = 5
+            with mock.patch('django.db.models.Model.save') as save:
+                Post.remote.fetch_wall(owner=owner)
+
+        update_fields = save.call_args[1]['update_fields']
+        self.assertTrue('likes' in update_fields)
+        for name in ['raw_html', 'attachments', 'media', 'geo', 'copy_text', 'text']:
+            self.assertFalse(name in update_fields, name)
+
+    def test_fetch_wall_resolves_copy_owners_of_page(self):
+        group = GroupFactory(remote_id=GROUP_ID)
+        users = [UserFactory(remote_id=1), UserFactory(remote_id=2)]
+        response = [3] + [{'id': i, 'to_id': -GROUP_ID, 'from_id': -GROUP_ID, 'date': 1298365200 + i, 'text': 'post',
+                           'copy_owner_id': copy_owner_id, 'copy_post_id': 10} for i, copy_owner_id in enumerate([1, 2, 1])]
+
+        with mock.patch('vkontakte_wall.models.Post.remote.api_call', side_effect=lambda *a, **kw: response):
+            with mock.patch('vkontakte_users.models.User.remote.fetch', return_value=users) as fetch:
+                posts = Post.remote.fetch_wall(owner=group)
+
+        self.assertEqual(fetch.call_count, 1)
+        self.assertItemsEqual(fetch.call_args[1]['ids'], [1, 2])
+        self.assertItemsEqual([post.copy_owner for post in posts], [users[0], users[1], users[0]])
+
+    def test_generic_fields_are_not_loaded_for_checking(self):
+        post = Post.objects.get(pk=PostFactory(wall_owner=GroupFactory(remote_id=GROUP_ID), author=UserFactory(remote_id=1)).pk)
+
+        with self.assertNumQueries(0):
+            post.prepare_generic_fields()
+            self.assertTrue(post.on_group_wall)
+            self.assertTrue(post.by_user)
+            self.assertFalse(post.on_user_wall)
+            self.assertFalse(post.by_group)
+
+    def test_content_type_id_follows_cache_of_content_types(self):
+        from models import get_content_type_id
+        from django.contrib.contenttypes.models import ContentType
+        ct_id = get_content_type_id(Group)
+        # content type is restored by rollback of the test, but not its cached id
+        self.addCleanup(ContentType.objects.clear_cache)
+
+        ContentType.objects.filter(pk=ct_id).delete()
+        ContentType.objects.clear_cache()
+        ct_id_new = get_content_type_id(Group)
+        self.assertNotEqual(ct_id_new, ct_id)
+        self.assertEqual(ct_id_new, ContentType.objects.get(app_label='vkontakte_groups', model='group').pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_content_type_id(Group), ct_id_new)
+
+    def test_save_only_changed_fields(self):
+        post = Post.objects.get(pk=PostFactory(wall_owner=GroupFactory(remote_id=GROUP_ID), author=UserFactory(remote_id=1)).pk)
+        self.assertEqual(post.get_fields_changed(), [])
+
+        post.likes = 10
+        self.assertEqual(post.get_fields_changed(), ['likes'])
+
+        with mock.patch('django.db.models.Model.save') as save:
+            post.save()
+        self.assertEqual(save.call_args[1]['update_fields'], ['likes'])
+
+        post.likes = 11
+        post.save()
+        self.assertEqual(Post.objects.get(pk=post.pk).likes, 11)
+        self.assertEqual(post.get_fields_changed(), [])
+
+    def test_save_assigned_raw_json(self):
+        post = PostFactory(wall_owner=GroupFactory(remote_id=GROUP_ID), author=UserFactory(remote_id=1), raw_json={'id': 1})
+        post = Post.objects.get(pk=post.pk)
+
+        post.raw_json = {'id': 2}
+        post.save()
+        self.assertEqual(Post.objects.full().get(pk=post.pk).raw_json, {'id': 2})
+
+        post = Post.objects.full().get(pk=post.pk)
+        post.raw_json['text'] = 'changed in place'
+        post.save()
+        self.assertEqual(Post.objects.full().get(pk=post.pk).raw_json, {'id': 2, 'text': 'changed in place'})
+
+    def test_compressed_raw_fields(self):
+        raw_html = u'<div class="post">Текст сообщения</div>' * 20
+        raw_json = {'id': 1, 'text': u'Текст сообщения' * 20}
+        post = PostFactory(wall_owner=GroupFactory(remote_id=GROUP_ID), author=UserFactory(remote_id=1), raw_html=raw_html, raw_json=raw_json)
+
+        stored_html, stored_json = Post.objects.filter(pk=post.pk).values_list('raw_html', 'raw_json')[0]
+        self.assertTrue(stored_html.startswith('zlib:'))
+        self.assertTrue(stored_json.startswith('zlib:'))
+        self.assertTrue(len(stored_html) < len(raw_html))
+
+        post = Post.objects.get(pk=post.pk)
+        self.assertEqual(post.raw_html, raw_html)
+        self.assertEqual(post.raw_json, raw_json)
+
+        # not compressed values of rows saved before are returned as is
+        Post.objects.filter(pk=post.pk).update(raw_html='<div></div>', raw_json='{"id": 1}')
+        post = Post.objects.get(pk=post.pk)
+        self.assertEqual(post.raw_html, '<div></div>')
+        self.assertEqual(post.raw_json, {'id': 1})
+
+    def test_lean_querysets(self):
+        group = GroupFactory(remote_id=GROUP_ID)
+        post = PostFactory(wall_owner=group, author=UserFactory(remote_id=1), attachments='[]', raw_json={'id': 1})
+
+        post = group.wall_posts.all()[0]
+        self.assertEqual(post, Post.objects.full().get(pk=post.pk))
+        for field_name in ['raw_json', 'raw_html', 'attachments', 'media', 'geo', 'copy_text']:
+            self.assertFalse(field_name in post.__dict__)
+        self.assertEqual(post.attachments, '[]')
+
+        # raw_json of full instance is deserialized only on access
+        post = Post.objects.full().get(pk=post.pk)
+        self.assertTrue(isinstance(post.__dict__['raw_json'], basestring))
+        self.assertEqual(post.raw_json, {'id': 1})
+        self.assertEqual(post.__dict__['raw_json'], {'id': 1})
+
+        post.likes = 5
+        post.save()
+        post = Post.objects.get(pk=post.pk)
+        self.assertEqual((post.likes, post.attachments, post.raw_json), (5, '[]', {'id': 1}))
+
+    @mock.patch('vkontakte_wall.models.RAW_ARCHIVE', True)
+    def test_raw_archive(self):
+        owner = GroupFactory(remote_id=GROUP_ID)
+        post = PostFactory(wall_owner=owner, author=UserFactory(remote_id=1), raw_html='<div>post</div>', raw_json={'id': 1})
+        self.assertEqual(post.raw_html, '<div>post</div>')
+
+        post = Post.objects.get(pk=post.pk)
+        self.assertEqual(post.raw_html, '')
+        self.assertEqual(post.raw_json, None)
+        self.assertEqual(post.get_raw_payload().raw_html, '<div>post</div>')
+        self.assertEqual(post.get_raw_payload().raw_json, {'id': 1})
+
+        # saving in bulk, only new raw_json is saved and raw_html is kept
+        instance = Post(remote_id=post.remote_id, wall_owner=owner, author=owner, date=post.date, raw_json={'id': 2}, raw_json_hash='2')
+        new_instance = Post(remote_id='-%s_2' % GROUP_ID, wall_owner=owner, author=owner, date=post.date, raw_html='<div>new</div>')
+        Post.remote.get_or_create_from_instances([instance, new_instance])
+
+        raw = Post.objects.get(pk=post.pk).get_raw_payload()
+        self.assertEqual((raw.raw_html, raw.raw_json), ('<div>post</div>', {'id': 2}))
+        self.assertEqual(Post.objects.get(remote_id='-%s_2' % GROUP_ID).get_raw_payload().raw_html, '<div>new</div>')
+        self.assertEqual(Post.objects.filter(raw_html='').count(), 2)
+
+    def test_parser_backends(self):
+        group = GroupFactory(remote_id=GROUP_ID, screen_name='group')
+        html = u'''<div><div class="post all own" id="post-%(id)d_10">
+            <a class="author" href="/group">Group</a>
+            <div class="wall_post_text"><b>Text of post</b></div>
+            <span class="rel_date">29 янв 2013</span>
+            <span class="post_like_count fl_l">5</span>
+            <div class="reply_text">reply</div><div class="reply_text">reply</div>
+        </div>
+        <div class="fw_reply" id="fwr_-%(id)d_11">
+            <a class="fw_reply_author" href="/group">Group</a>
+            <div class="fw_reply_text">Text of comment</div>
+            <span class="rel_date">31 дек 2012</span>
+            <span class="like_count fl_l">3</span>
+            <span class="likes_count">4</span>
+        </div></div>''' % {'id': GROUP_ID}
+
+        # BeautifulSoup is used by default
+        self.assertFalse(VkontakteWallParser('').lxml)
+
+        for lxml in [False, True]:
+            parser = VkontakteWallParser('<!>' * 5 + html, lxml=lxml)
+
+            items = parser.get_posts(GROUP_ID)
+            self.assertEqual(len(items), 1)
+            # text after the element is not a part of it
+            self.assertTrue(parser.to_html(items[0]).endswith('</div>'))
+            post = parser.parse_post(items[0], group)
+            self.assertEqual(post.remote_id, '-%s_10' % GROUP_ID)
+            self.assertEqual(post.text, 'Text of post')
+            self.assertEqual(post.date, datetime(2013, 1, 29))
+            self.assertEqual(post.likes, 5)
+            self.assertEqual(post.comments, 2)
+            self.assertEqual(post.author, group)
+
+            items = parser.get_comments()
+            self.assertEqual(len(items), 1)
+            comment = parser.parse_comment(items[0], group)
+            self.assertEqual(comment.remote_id, '-%s_11' % GROUP_ID)
+            self.assertEqual(comment.text, 'Text of comment')
+            self.assertEqual(comment.date, datetime(2012, 12, 31))
+            self.assertEqual(comment.likes, 3)
+            self.assertEqual(comment.author, group)
+
+            # signature of VkontakteParser.parse_container_likes with class names
+            self.assertEqual(parser.parse_container_likes(items[0], 'like_count fl_l'), 3)
+            self.assertEqual(parser.parse_container_likes(items[0], 'likes_count'), 4)
+            self.assertEqual(parser.parse_likes(items[0], 'comment_likes'), 3)
+
+    def test_parser_instances_of_page(self):
+        group = GroupFactory(remote_id=GROUP_ID, screen_name='group')
+        post = PostFactory(remote_id='-%s_10' % GROUP_ID, wall_owner=group)
+        html = u'''<div><div class="post all own" id="post-%(id)d_10">
+            <a class="author" href="/group">Group</a>
+            <span class="rel_date">29 янв 2013</span>
+            <span class="post_like_count fl_l">5</span>
+        </div></div>''' % {'id': GROUP_ID}
+
+        parser = VkontakteWallParser('<!>' * 5 + html)
+        items = parser.get_posts(GROUP_ID)
+        with self.assertNumQueries(1):
+            instances = parser.get_instances(Post, items)
+        with self.assertNumQueries(0):
+            instance = parser.parse_post(items[0], group, instances)
+
+        self.assertEqual(instance.pk, post.pk)
+        self.assertEqual(instance.likes, 5)
+
+    def test_parser_saves_only_changed_users(self):
+        user1 = UserFactory(remote_id=1, first_name='Ivan', last_name='Ivanov', photo='http://photo1', screen_name='ivan')
+        user2 = UserFactory(remote_id=2, first_name='Petr', last_name='Petrov', photo='http://photo2', screen_name='petr')
+        user3 = UserFactory(remote_id=3, first_name='Olga', last_name='Ivanova', photo='http://photo3', screen_name='id3')
+        parser = VkontakteWallParser(defer_users_saving=True)
+
+        with mock.patch('vkontakte_users.models.User.save') as save:
+            parser.update_user(user1, ['Ivan', 'Ivanov'], 'http://photo1', 'ivan')
+            parser.update_user(user2, ['Petr', 'Sidorov'], 'http://photo2')
+            parser.update_user(user2, ['Petr', 'Sidorov'], 'http://photo3')
+            parser.update_user(user3, ['Olga', 'Ivanova'], 'http://photo3', 'olga')
+        self.assertEqual(save.call_count, 0)
+        self.assertItemsEqual(parser.users_changed.values(), [user2, user3])
+
+        with self.assertNumQueries(1):
+            parser.save_users()
+
+        user2 = User.objects.get(pk=user2.pk)
+        self.assertEqual((user2.last_name, user2.photo, user2.screen_name), ('Sidorov', 'http://photo3', 'petr'))
+        self.assertEqual(User.objects.get(pk=user1.pk).photo, 'http://photo1')
+        self.assertEqual(User.objects.get(pk=user3.pk).screen_name, 'olga')
+
+    def test_parser_saves_screen_names_of_resolved_users(self):
+        slug_cache.clear()
+        user = UserFactory(remote_id=7, first_name='Ivan', last_name='Ivanov', photo='http://photo1', screen_name='old')
+        parser = VkontakteWallParser()
+
+        # resolved by remote id in slug, not by stored screen name
+        parser.objects_by_slug = resolve_slugs(['id7'])
+        parser.update_user(parser.get_object_by_slug('id7'), ['Ivan', 'Ivanov'], 'http://photo1', 'id7')
+        self.assertEqual(User.objects.get(pk=user.pk).screen_name, 'id7')
+
+    def test_resolve_slugs(self):
+        slug_cache.clear()
+        # stale screen names in DB, the first one was reassigned to another user
+        UserFactory(remote_id=4, screen_name='known')
+        UserFactory(remote_id=6, screen_name='known')
+        UserFactory(remote_id=5, screen_name='old')
+        responses = {'known': {'type': 'user', 'object_id': 5}, 'unknown_user': {'type': 'user', 'object_id': 8},
+                     'unknown_group': {'type': 'page', 'object_id': 9}, 'missing': []}
+
+        def api_call(method, code, **kwargs):
+            return [responses[slug] for slug in re.findall(r'"screen_name": "(\w+)"', code)]
+
+        with mock.patch('vkontakte_wall.utils.api_call', side_effect=api_call) as execute:
+            for i in range(2):
+                instances = resolve_slugs(['known', 'id7', 'club10', 'unknown_user', 'unknown_group', 'missing'])
+
+                self.assertEqual(execute.call_count, 1)
+                self.assertEqual(instances['known'].remote_id, 5)
+                self.assertEqual([(instances[slug].__class__, instances[slug].remote_id) for slug in ['id7', 'club10', 'unknown_user', 'unknown_group']],
+                                 [(User, 7), (Group, 10), (User, 8), (Group, 9)])
+                self.assertEqual(instances['unknown_group'].screen_name, 'unknown_group')
+                self.assertEqual(instances['missing'], None)
+
+    def test_fetch_walls(self):
+        owner1 = UserFactory(remote_id=USER_ID)
+        owner2 = GroupFactory(remote_id=GROUP_ID)
+
+        def api_call(*args, **kwargs):
+            if kwargs['owner_id'] == -GROUP_ID:
+                raise Exception('Access denied')
+            return [1, {'id': 1, 'to_id': USER_ID, 'from_id': USER_ID, 'date': 1298365200, 'text': 'post'}]
+
+        with mock.patch('vkontakte_wall.models.Post.remote.api_call', side_effect=api_call):
+            summary = Post.remote.fetch_walls([owner1, owner2])
+
+        self.assertEqual(summary[owner1], {'posts': 1, 'error': None})
+        self.assertEqual(summary[owner2], {'posts': 0, 'error': 'Access denied'})
+        self.assertEqual(Post.objects.count(), 1)
+
+    def test_fetch_walls_execute(self):
+        owner1 = UserFactory(remote_id=USER_ID)
+        owner2 = GroupFactory(remote_id=GROUP_ID)
+        responses = [[2] + [{'id': i, 'to_id': USER_ID, 'from_id': USER_ID, 'date': 1298365200 + i, 'text': 'post'} for i in [1, 2]],
+                     [1, {'id': 3, 'to_id': -GROUP_ID, 'from_id': -GROUP_ID, 'date': 1298365203, 'text': 'post'}],
+                     False]
+
+        with mock.patch('vkontakte_wall.utils.api_call', side_effect=lambda *a, **kw: responses) as api_call:
+            posts = Post.remote.fetch_walls_execute([owner1, owner2, owner2], count=50)
+
+        self.assertEqual(api_call.call_count, 1)
+        self.assertEqual(api_call.call_args[0][0], 'execute')
+        self.assertEqual(api_call.call_args[1]['code'].count('API.wall.get('), 3)
+        self.assertEqual(posts.count(), Post.objects.count(), 3)
+        self.assertItemsEqual(posts.values_list('remote_id', flat=True), ['%s_1' % USER_ID, '%s_2' % USER_ID, '-%s_3' % GROUP_ID])
+
+    def test_fetch_wall_resolves_owners_and_authors_of_page(self):
+        group = GroupFactory(remote_id=GROUP_ID)
+        response = [3] + [{'id': i, 'to_id': -GROUP_ID, 'from_id': from_id, 'date': 1298365200 + i, 'text': 'post %d' % i}
+                          for i, from_id in enumerate([-GROUP_ID, 1, 2])]
+
+        with mock.patch('vkontakte_wall.models.Post.remote.api_call', side_effect=lambda *a, **kw: response):
+            posts = Post.remote.fetch_wall(owner=group)
+
+        self.assertEqual(posts.count(), 3)
+        self.assertEqual(User.objects.filter(remote_id__in=[1, 2]).count(), 2)
+        self.assertItemsEqual([post.author for post in posts], [group] + list(User.objects.filter(remote_id__in=[1, 2])))
+        self.assertTrue(all([post.wall_owner == group for post in posts]))
+
+    def test_get_or_create_groups_and_users_created_by_another_worker(self):
+        bulk_create = User.objects.bulk_create
+
+        def bulk_create_after_another_worker(objs, *args, **kwargs):
+            # another worker inserts the same user between selecting and creating
+            UserFactory(remote_id=1)
+            return bulk_create(objs, *args, **kwargs)
+
+        with mock.patch.object(User.objects, 'bulk_create', side_effect=bulk_create_after_another_worker):
+            instances = Post.remote.get_or_create_groups_and_users([1, 2, -GROUP_ID])
+
+        self.assertItemsEqual(instances.keys(), [1, 2, -GROUP_ID])
+        self.assertEqual(User.objects.filter(remote_id__in=[1, 2]).count(), 2)
+        self.assertEqual(instances[1], User.objects.get(remote_id=1))
+        self.assertEqual(instances[-GROUP_ID], Group.objects.get(remote_id=GROUP_ID))
+
     def test_parse_comment(self):
 
         response = '''{"response":[6,
@@ -499,6 +1084,40 @@ class VkontakteWallTest(TestCase):
         self.assertEqual(instance.remote_id, '%s_2507' % USER_ID)
         self.assertEqual(instance.reply_for.remote_id, 16271479)
 
+    def test_fetch_post_comments_resolves_replies_of_page(self):
+        user = UserFactory(remote_id=USER_ID)
+        post = PostFactory(remote_id=POST_ID, wall_owner=user)
+        response = [3,
+            {'cid': 3, 'uid': 2, 'date': 1298365203, 'text': 'reply', 'reply_to_uid': 1, 'reply_to_cid': 1},
+            {'cid': 2, 'uid': 1, 'date': 1298365202, 'text': 'comment 2'},
+            {'cid': 1, 'uid': 1, 'date': 1298365201, 'text': 'comment 1'}]
+
+        with mock.patch('vkontakte_wall.models.Comment.remote.api_call', side_effect=lambda *a, **kw: response):
+            comments = Comment.remote.fetch_post(post=post, sort='desc')
+
+        self.assertEqual(comments.count(), 3)
+        reply = Comment.objects.get(remote_id='%s_3' % USER_ID)
+        self.assertEqual(reply.reply_to, Comment.objects.get(remote_id='%s_1' % USER_ID))
+        self.assertEqual(reply.reply_for, User.objects.get(remote_id=1))
+        self.assertEqual(reply.author, User.objects.get(remote_id=2))
+
+    def test_fetch_post_comments_bulk_resolves_replies_of_page(self):
+        user = UserFactory(remote_id=USER_ID)
+        post = PostFactory(remote_id=POST_ID, wall_owner=user)
+        response = [3,
+            {'cid': 3, 'uid': 2, 'date': 1298365203, 'text': 'reply', 'reply_to_uid': 1, 'reply_to_cid': 1},
+            {'cid': 2, 'uid': 1, 'date': 1298365202, 'text': 'comment 2', 'reply_to_uid': 1, 'reply_to_cid': 100},
+            {'cid': 1, 'uid': 1, 'date': 1298365201, 'text': 'comment 1'}]
+
+        with mock.patch('vkontakte_wall.models.Comment.remote.api_call', side_effect=lambda *a, **kw: response):
+            comments = Comment.remote.fetch_post(post=post, sort='desc', bulk=True)
+
+        self.assertEqual(comments.count(), 3)
+        reply = Comment.objects.get(remote_id='%s_3' % USER_ID)
+        self.assertEqual(reply.reply_to, Comment.objects.get(remote_id='%s_1' % USER_ID))
+        # comment replied to is not fetched
+        self.assertEqual(Comment.objects.get(remote_id='%s_2' % USER_ID).reply_to, None)
+
     def test_post_prepare_create_params(self):
         text = 'test text'
         expected_config = {
@@ -523,7 +1142,7 @@ class VkontakteWallTest(TestCase):
 
     def test_post_prepare_update_params(self):
         group = GroupFactory(remote_id=GROUP_ID)
-        post = PostFactory(remote_id='%s_17' % GROUP_ID, wall_owner=group)
+        post = PostFactory(remote_id='-%s_17' % GROUP_ID, wall_owner=group)
         update_text = 'update text'
         expected_config = {
             'owner_id': GROUP_ID * -1,
@@ -545,13 +1164,26 @@ class VkontakteWallTest(TestCase):
 
     def test_post_prepare_delete_params(self):
         group = GroupFactory(remote_id=GROUP_ID)
-        post = PostFactory(remote_id='%s_17' % GROUP_ID, wall_owner=group)
+        post = PostFactory(remote_id='-%s_17' % GROUP_ID, wall_owner=group)
         expected_params = {
             'owner_id': GROUP_ID * -1,
             'post_id': '17',
         }
         self.assertEqual(post.prepare_delete_params(), expected_params)
 
+    def test_integer_remote_id_parts(self):
+        group = GroupFactory(remote_id=GROUP_ID)
+        post = PostFactory(remote_id='-%s_17' % GROUP_ID, wall_owner=group)
+        self.assertEqual((post.owner_remote_id, post.item_remote_id), (-GROUP_ID, 17))
+
+        post = Post.objects.get(owner_remote_id=-GROUP_ID, item_remote_id=17)
+        with self.assertNumQueries(0):
+            self.assertEqual(post.prepare_delete_params(), {'owner_id': -GROUP_ID, 'post_id': '17'})
+
+        comment = Comment(post=post)
+        comment.parse({'cid': 25, 'uid': 1, 'date': int(time.time()), 'text': ''})
+        self.assertEqual((comment.remote_id, comment.owner_remote_id, comment.item_remote_id), ('-%s_25' % GROUP_ID, -GROUP_ID, 25))
+
     def test_post_crud_methods(self):
         group = GroupFactory(remote_id=GROUP_CRUD_ID)
         user = UserFactory(remote_id=USER_AUTHOR_ID)
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+from vkontakte_api.utils import api_call
+import threading
+import json
+import logging
+import time
+
+__all__ = ['execute_api_calls', 'RateLimiter', 'rate_limiter']
+
+log = logging.getLogger('vkontakte_wall')
+
+# maximum amount of API calls inside one `execute` request
+EXECUTE_CALLS_LIMIT = 25
+
+# limit of API requests per second of the whole application, disabled by default
+API_REQUESTS_PER_SECOND = getattr(settings, 'VKONTAKTE_WALL_API_REQUESTS_PER_SECOND', None)
+
+
+class RateLimiter(object):
+    '''
+    Token bucket limiting amount of API requests per second, safe for sharing between threads.
+    Rate equal to None or 0 means no limit
+    '''
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        '''
+        Take one token, sleeping until it is available
+        '''
+        if not self.rate:
+            return
+
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # token is reserved in advance, so concurrent callers wait in turn
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait:
+            time.sleep(wait)
+
+# limiter shared by all API requests of the application, does nothing unless the limit is set
+rate_limiter = RateLimiter(API_REQUESTS_PER_SECOND)
+
+
+def execute_api_calls(calls, **kwargs):
+    '''
+    Call list of API methods packed into `execute` requests by EXECUTE_CALLS_LIMIT calls in each.
+    Argument `calls` is a list of tuples (method, params), for example ('wall.get', {'owner_id': 1, 'offset': 100}).
+    Return list of responses in the same order, failed calls are None.
+    '''
+    responses = []
+    for i in range(0, len(calls), EXECUTE_CALLS_LIMIT):
+        chunk = calls[i:i + EXECUTE_CALLS_LIMIT]
+        code = 'return [%s];' % ','.join(['API.%s(%s)' % (method, json.dumps(dict([(key, value) for key, value in params.items() if value is not None])))
+                                         for method, params in chunk])
+
+        log.debug('Executing %d API calls in one request' % len(chunk))
+
+        rate_limiter.acquire()
+        response = api_call('execute', code=code, **kwargs)
+        for (method, params), method_response in zip(chunk, response):
+            if method_response is False:
+                log.error("Method %s with params %s returned error inside execute request" % (method, params))
+                method_response = None
+            responses += [method_response]
+
+    return responses